@@ -0,0 +1,80 @@
+"""Memory used by rows held in memory
+
+Reads rows with the reader classes and reports the memory allocated per
+100k rows kept in a list, as dicts and as compact records, with and
+without interning the values of the readers' `interned_fields`. Defaults to the
+cities1000.txt extract bundled with the tests, which is read repeatedly
+until `--rows` rows are held::
+
+    $ python benchmarks/memory.py --rows 100000
+
+Requires Python 3.4+ (tracemalloc).
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import sys
+from itertools import chain, islice, repeat
+
+from sqlalchemy_geonames import reader
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(__file__), os.pardir,
+                              'sqlalchemy_geonames', 'tests', 'files')
+DEFAULT_FILEPATH = os.path.join(TEST_FILES_DIR, 'cities1000.txt')
+
+# Name: reader keyword arguments
+MODES = (
+    ('dict', {'interned_fields': ()}),
+    ('records', {'records': True, 'interned_fields': ()}),
+    ('interned', {}),
+    ('interned records', {'records': True}),
+    ('encoded records', {'records': True, 'dictionary_encode': True}),
+)
+
+
+def measure_rows(file_class, filepath, num_rows, reader_kwargs):
+    """Returns the number of rows read and the bytes allocated to hold them
+    """
+    import tracemalloc
+
+    readers = (file_class(filepath, **reader_kwargs) for _ in repeat(None))
+    rows_iter = islice(chain.from_iterable(readers), num_rows)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        rows = list(rows_iter)
+        gc.collect()
+        allocated, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return len(rows), allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('filepath', nargs='?', default=DEFAULT_FILEPATH)
+    parser.add_argument('-r', '--reader', default='GeonameReader',
+                        help='Reader class in sqlalchemy_geonames.reader')
+    parser.add_argument('-n', '--rows', type=int, default=100000,
+                        help='Number of rows to hold in memory')
+    args = parser.parse_args()
+    if sys.version_info < (3, 4):
+        parser.error('tracemalloc requires Python 3.4+')
+    file_class = getattr(reader, args.reader)
+
+    print(u'{:<24} {:<18} {:>10} {:>16} {:>10}'.format(
+        'File', 'Mode', 'Rows', 'MB per 100k rows', 'Bytes/row'))
+    for mode, reader_kwargs in MODES:
+        num_rows, allocated = measure_rows(file_class, args.filepath,
+                                           args.rows, reader_kwargs)
+        print(u'{:<24} {:<18} {:>10} {:>16.1f} {:>10.0f}'.format(
+            os.path.basename(args.filepath), mode, num_rows,
+            allocated * 100000.0 / num_rows / 1024 / 1024,
+            allocated / float(num_rows)))
+
+
+if __name__ == '__main__':
+    main()
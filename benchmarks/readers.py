@@ -0,0 +1,94 @@
+"""Reader throughput benchmarks
+
+Times iterating data dumps with the reader classes. Defaults to the
+cities1000.txt extract bundled with the tests, pass the paths of bigger
+dumps (e.g. allCountries.txt) to benchmark those instead::
+
+    $ python benchmarks/readers.py ~/.sqlageonames/allCountries.txt
+
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+from sqlalchemy_geonames import reader
+
+TEST_FILES_DIR = os.path.join(os.path.dirname(__file__), os.pardir,
+                              'sqlalchemy_geonames', 'tests', 'files')
+DEFAULT_FILEPATHS = [os.path.join(TEST_FILES_DIR, 'cities1000.txt')]
+
+
+def per_cell_reader(file_class, filepath):
+    """Converts cells one at a time, like readers did before row parsers
+    were compiled.
+    """
+    reader_instance = file_class(filepath, engine='lines')
+    reader_instance.row_parser = reader_instance.convert_cells
+    return reader_instance
+
+
+def reader_with(**reader_kwargs):
+    def create_reader(file_class, filepath):
+        return file_class(filepath, **reader_kwargs)
+    return create_reader
+
+
+# Name: function creating the reader to iterate
+MODES = (
+    ('mmap', reader_with(engine='mmap')),
+    ('lines', reader_with(engine='lines')),
+    ('per-cell', per_cell_reader),
+    ('float', reader_with(coordinates='float')),
+    ('text', reader_with(coordinates='text')),
+)
+
+
+def time_reader(file_class, filepath, create_reader, repeat):
+    """Returns the number of rows and the best time of `repeat` runs"""
+    best = None
+    num_rows = 0
+    for _ in range(repeat):
+        reader_instance = create_reader(file_class, filepath)
+        started = time.time()
+        num_rows = 0
+        for _ in reader_instance:
+            num_rows += 1
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return num_rows, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('filepaths', nargs='*', default=DEFAULT_FILEPATHS)
+    parser.add_argument('-r', '--reader', default='GeonameReader',
+                        help='Reader class in sqlalchemy_geonames.reader')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='Best of this many runs is reported')
+    parser.add_argument('-m', '--mode', action='append',
+                        choices=[mode for mode, _ in MODES],
+                        help='Only run the given mode(s). The float and '
+                             'text modes set the reader\'s `coordinates`, '
+                             'per-cell reads lines without a compiled '
+                             'row parser.')
+    args = parser.parse_args()
+    file_class = getattr(reader, args.reader)
+    modes = [(mode, create_reader) for mode, create_reader in MODES
+             if not args.mode or mode in args.mode]
+
+    print(u'{:<24} {:<10} {:>10} {:>10} {:>12}'.format(
+        'File', 'Mode', 'Rows', 'Seconds', 'Rows/s'))
+    for filepath in args.filepaths:
+        for mode, create_reader in modes:
+            num_rows, seconds = time_reader(file_class, filepath,
+                                            create_reader, args.repeat)
+            print(u'{:<24} {:<10} {:>10} {:>10.3f} {:>12.0f}'.format(
+                os.path.basename(filepath), mode, num_rows, seconds,
+                num_rows / seconds))
+
+
+if __name__ == '__main__':
+    main()
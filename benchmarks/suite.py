@@ -0,0 +1,286 @@
+"""Benchmark suite run on synthetic data dumps
+
+Generates dumps with `synthetic.py` and measures:
+
+* `reader` rows/sec of each reader class with a synthetic dump.
+* `modifiers` rows/sec of the modifiers of the geoname and postal code
+  importers, for each set of modifiers the write methods use.
+* `import` rows/sec of importing all dumps into a database, per table.
+  PostgreSQL/PostGIS if `--db-url` is given, in which the geoname tables
+  are recreated. Otherwise a SQLite stand-in with INSERTs, which leaves out
+  PostGIS but still measures everything up to the database.
+
+Results are appended to a JSON history file and compared with the last run
+with the same rows, seed and database, so regressions show up between
+releases::
+
+    $ python benchmarks/suite.py --rows 200000
+    $ python benchmarks/suite.py --rows 200000 \\
+          --db-url postgresql://sqla_geonames@localhost/sqla_geonames
+
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from geoalchemy2 import Geography
+from sqlalchemy import MetaData, Text, create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from sqlalchemy_geonames import reader, scheduling
+from sqlalchemy_geonames.imports import Importer, _get_import_filename, \
+    _import_options_map, get_importer_instances
+from sqlalchemy_geonames.metadata import __version__
+from sqlalchemy_geonames.sqla import config, create_db_engine, \
+    create_geoname_tables
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic  # noqa
+
+BENCHMARKS = ('reader', 'modifiers', 'import')
+DEFAULT_HISTORY_PATH = os.path.join(os.path.dirname(__file__),
+                                    'history.json')
+
+# Dumps of the importers whose modifiers are measured
+MODIFIER_DUMPS = ('GeonameReader', 'GeonamePostalCodeReader')
+
+
+def best_of(repeat, func):
+    """Best seconds of `repeat` calls of `func` and its last return value"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.time()
+        result = func()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def result(benchmark, name, rows, seconds):
+    return {'benchmark': benchmark, 'name': name, 'rows': rows,
+            'seconds': round(seconds, 4),
+            'rows_per_second': round(rows / seconds) if seconds else None}
+
+
+def create_sqlite_engine(directory):
+    """SQLite database standing in for PostgreSQL in `directory`
+
+    Points are stored as WKT text, as made by the `insert` write method's
+    modifiers.
+    """
+    filepath = os.path.join(directory, 'geonames.sqlite')
+    schema_filepath = os.path.join(directory, 'geonames-schema.sqlite')
+    engine = create_engine('sqlite:///' + filepath)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        if config.schema_name:
+            dbapi_connection.execute(u'ATTACH DATABASE ? AS {}'.format(
+                config.schema_name), (schema_filepath, ))
+        dbapi_connection.create_function('ST_GeogFromText', 1,
+                                         lambda wkt: wkt)
+
+    metadata = MetaData()
+    for table in config.Base.metadata.sorted_tables:
+        table_copy = table.tometadata(metadata)
+        for column in table_copy.columns:
+            if isinstance(column.type, Geography):
+                column.type = Text()
+    metadata.create_all(bind=engine)
+    return engine
+
+
+def run_reader_benchmarks(dumps, repeat):
+    results = []
+    for reader_name, filepath in dumps.items():
+        file_class = getattr(reader, reader_name)
+        seconds, num_rows = best_of(
+            repeat, lambda: sum(1 for _ in file_class(filepath)))
+        results.append(result('reader', reader_name, num_rows, seconds))
+    return results
+
+
+def run_modifier_benchmarks(dumps, session, data_dir, repeat):
+    """Seconds spent in the modifiers of importers reading the dumps, as
+    timed by their `instrumentation.ImportStats`
+    """
+    results = []
+    for reader_name in MODIFIER_DUMPS:
+        filepath = dumps[reader_name]
+        options = _import_options_map[_get_import_filename(filepath,
+                                                           data_dir)]
+        for write_method in ('insert', 'binary_copy'):
+            best = None
+            for _ in range(repeat):
+                importer = Importer(options, filepath, session, data_dir,
+                                    write_method=write_method)
+                num_rows = sum(len(batch)
+                               for batch in importer.iter_batches())
+                seconds = importer.stats.stages['modify']
+                best = seconds if best is None else min(best, seconds)
+            results.append(result(
+                'modifiers', u'{} ({})'.format(importer.table.name,
+                                               write_method),
+                num_rows, best))
+    return results
+
+
+def run_import_benchmarks(dumps, session, data_dir, write_method=None):
+    filepaths = [filepath for reader_name, filepath in dumps.items()
+                 if reader_name != 'GeonameDeletesReader']
+    importers = get_importer_instances(session, data_dir, *filepaths,
+                                       write_method=write_method)
+    started = time.time()
+    scheduling.run_importers(importers)
+    seconds = time.time() - started
+    results = [result('import', importer.table.name, importer.stats.rows,
+                      importer.stats.seconds)
+               for importer in importers]
+    results.append(result('import', 'total',
+                          sum(importer.stats.rows for importer in importers),
+                          seconds))
+    return results
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(filepath):
+    if not os.path.exists(filepath):
+        return []
+    with io.open(filepath, encoding='utf-8') as fh:
+        return json.load(fh)
+
+
+def save_history(filepath, history):
+    # Write to a temporary file first so the history is never left half
+    # written
+    temp_filepath = filepath + '.tmp'
+    with io.open(temp_filepath, 'w', encoding='utf-8') as fh:
+        fh.write(json.dumps(history, indent=2, sort_keys=True,
+                            ensure_ascii=False))
+        fh.write(u'\n')
+    os.rename(temp_filepath, filepath)
+
+
+def get_previous_rates(history, entry):
+    """Rows/sec of each result of the last run comparable with `entry`"""
+    for previous in reversed(history):
+        if all(previous[key] == entry[key]
+               for key in ('rows', 'seed', 'database')):
+            return dict(((r['benchmark'], r['name']), r['rows_per_second'])
+                        for r in previous['results'])
+    return {}
+
+
+def print_results(results, previous_rates):
+    print(u'{:<10} {:<28} {:>10} {:>9} {:>11} {:>8}'.format(
+        'Benchmark', 'Name', 'Rows', 'Seconds', 'Rows/s', 'Change'))
+    for r in results:
+        previous = previous_rates.get((r['benchmark'], r['name']))
+        change = u''
+        if previous and r['rows_per_second']:
+            change = u'{:+.1f}%'.format(
+                (r['rows_per_second'] - previous) * 100.0 / previous)
+        print(u'{:<10} {:<28} {:>10} {:>9.3f} {:>11} {:>8}'.format(
+            r['benchmark'], r['name'], r['rows'], r['seconds'],
+            r['rows_per_second'], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--rows', type=int, default=100000,
+                        help='Rows of the geoname and postal code dumps')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='Best of this many runs is reported, except '
+                             'for imports')
+    parser.add_argument('-b', '--benchmark', action='append',
+                        choices=BENCHMARKS,
+                        help='Only run the given benchmark(s)')
+    parser.add_argument('-d', '--db-url', default=None,
+                        help='PostgreSQL database to import into. Its '
+                             'geoname tables are dropped and recreated. '
+                             'Defaults to a SQLite stand-in.')
+    parser.add_argument('-D', '--data-dir', default=None,
+                        help='Where to write the dumps. Defaults to a '
+                             'temporary directory, removed afterwards.')
+    parser.add_argument('-H', '--history', default=DEFAULT_HISTORY_PATH,
+                        help='JSON file the results are appended to')
+    parser.add_argument('--no-history', action='store_true',
+                        help="Don't record the results")
+    args = parser.parse_args()
+    benchmarks = args.benchmark or BENCHMARKS
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='sqlageonames-')
+    try:
+        print(u'Writing synthetic dumps to {}...'.format(data_dir))
+        dumps = synthetic.write_dumps(data_dir, args.rows, args.seed)
+        if args.db_url:
+            engine = create_db_engine(args.db_url)
+            session = sessionmaker(bind=engine)()
+            create_geoname_tables(session, recreate_tables=True)
+            write_method = None
+        else:
+            engine = create_sqlite_engine(data_dir)
+            session = sessionmaker(bind=engine)()
+            write_method = 'insert'
+
+        results = []
+        if 'reader' in benchmarks:
+            results.extend(run_reader_benchmarks(dumps, args.repeat))
+        if 'modifiers' in benchmarks:
+            results.extend(run_modifier_benchmarks(dumps, session, data_dir,
+                                                   args.repeat))
+        if 'import' in benchmarks:
+            results.extend(run_import_benchmarks(dumps, session, data_dir,
+                                                 write_method))
+        session.close()
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir)
+
+    entry = {
+        'date': datetime.utcnow().isoformat(),
+        'version': __version__,
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': engine.dialect.name,
+        'rows': args.rows,
+        'seed': args.seed,
+        'results': results,
+    }
+    history = load_history(args.history)
+    print()
+    print_results(results, get_previous_rates(history, entry))
+    if not args.no_history:
+        history.append(entry)
+        save_history(args.history, history)
+        print()
+        print(u'Results appended to {}'.format(args.history))
+
+
+if __name__ == '__main__':
+    main()
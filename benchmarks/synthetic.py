@@ -0,0 +1,232 @@
+"""Synthetic GeoNames data dumps
+
+Writes files in the formats of geonames' dumps, for each reader class with
+field definitions, with made up but realistically distributed values: a
+few countries and feature codes make up most rows, most geonames have no
+population or elevation, some names aren't ASCII and so on. Output is the
+same for the same seed.
+
+The country, timezone and feature code files get about as many rows as the
+real ones. The others get `--rows` rows and refer only to countries,
+timezones and feature codes in those files, so the whole set can be
+imported::
+
+    $ python benchmarks/synthetic.py --rows 1000000 /tmp/geonames
+
+`GeonameHierarchyReader` and `GeonameAlternateNamesReader` are left out.
+They have no field definitions yet, so they can't read any file to
+benchmark. Their dumps belong here once they do.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import io
+import os
+import random
+import string
+import unicodedata
+from collections import OrderedDict
+from datetime import date, timedelta
+
+# Rows of the files with one row per country, timezone and feature code
+NUM_COUNTRIES = 250
+NUM_TIMEZONES = 420
+NUM_FEATURES = 680
+
+SYLLABLES = (u'ka', u'lo', u'ma', u'ri', u'sen', u'to', u'vik', u'berg',
+             u'an', u'sta', u'dor', u'el', u'mu', u'ne', u'por', u'qui',
+             u'hol', u'ström', u'ås', u'gé', u'ñe', u'ür', u'ło', u'ø')
+CONTINENTS = (u'AF', u'AS', u'EU', u'NA', u'OC', u'SA', u'AN')
+# Real feature codes come first, as they are the most used ones
+FEATURE_CODES = ((u'P', u'PPL'), (u'H', u'STM'), (u'T', u'MT'),
+                 (u'S', u'HTL'), (u'P', u'PPLA'), (u'A', u'ADM2'),
+                 (u'H', u'LK'), (u'L', u'AREA'), (u'V', u'FRST'),
+                 (u'S', u'SCH'), (u'P', u'PPLC'), (u'R', u'RD'),
+                 (u'U', u'SMU'), (u'A', u'ADM1'))
+FEATURE_CLASSES = u'AHLPRSTUV'
+FIRST_DATE = date(2010, 1, 1)
+
+
+def skewed_index(rng, size):
+    """Random index below `size`, low ones being much more likely"""
+    return min(int(rng.paretovariate(1.1)) - 1, size - 1)
+
+
+def make_name(rng, words=(1, 3)):
+    return u' '.join(
+        u''.join(rng.choice(SYLLABLES)
+                 for _ in range(rng.randint(2, 4))).capitalize()
+        for _ in range(rng.randint(*words)))
+
+
+def ascii_name(name):
+    return unicodedata.normalize('NFKD', name).encode(
+        'ascii', 'ignore').decode('ascii')
+
+
+def country_code(index):
+    letters = string.ascii_uppercase
+    return letters[index // 26 % 26] + letters[index % 26]
+
+
+def timezone_id(index):
+    # Each country has one or two timezones
+    return u'{}/Zone{}'.format(CONTINENTS[index % len(CONTINENTS)], index)
+
+
+def feature_code(index):
+    if index < len(FEATURE_CODES):
+        return FEATURE_CODES[index]
+    return (FEATURE_CLASSES[index % len(FEATURE_CLASSES)],
+            u'F{:04d}'.format(index))
+
+
+def random_date(rng):
+    return (FIRST_DATE + timedelta(days=rng.randint(0, 5000))).isoformat()
+
+
+def geoname_row(rng, rownum):
+    name = make_name(rng)
+    alternatenames = u''
+    if rng.random() < 0.4:
+        alternatenames = u','.join(make_name(rng, (1, 2)) for _
+                                   in range(rng.randint(1, 8)))
+    feature_class, code = feature_code(skewed_index(rng, NUM_FEATURES))
+    country = skewed_index(rng, NUM_COUNTRIES)
+    timezone = country + NUM_COUNTRIES * rng.randint(0, 1)
+    if timezone >= NUM_TIMEZONES:
+        timezone = country
+    population = u'0'
+    if rng.random() < 0.15:
+        population = str(int(rng.lognormvariate(7, 2)))
+    elevation = u''
+    if rng.random() < 0.2:
+        elevation = str(rng.randint(-50, 4000))
+    return [str(rownum + 1), name, ascii_name(name), alternatenames,
+            u'{:.5f}'.format(rng.uniform(-90, 90)),
+            u'{:.5f}'.format(rng.uniform(-180, 180)),
+            feature_class, code, country_code(country),
+            country_code(rng.randrange(NUM_COUNTRIES))
+            if rng.random() < 0.03 else u'',
+            u'{:02d}'.format(rng.randint(0, 30)),
+            str(rng.randint(1, 999)) if rng.random() < 0.5 else u'',
+            str(rng.randint(1, 9999)) if rng.random() < 0.1 else u'',
+            u'', population, elevation, str(rng.randint(-9999, 4000)),
+            timezone_id(timezone), random_date(rng)]
+
+
+def postal_code_row(rng, rownum):
+    country = skewed_index(rng, 30)
+    admin1 = rng.randint(1, 16)
+    admin2 = rng.randint(1, 40)
+    return [country_code(country), str(rownum + 1), make_name(rng, (1, 2)),
+            u'State {}'.format(admin1), u'{:02d}'.format(admin1),
+            u'County {}'.format(admin2), u'{:05d}'.format(admin2),
+            u'', u'', u'{:.4f}'.format(rng.uniform(-90, 90)),
+            u'{:.4f}'.format(rng.uniform(-180, 180)),
+            str(rng.randint(1, 6)) if rng.random() < 0.9 else u'']
+
+
+def deletes_row(rng, rownum):
+    return [str(rng.randint(1, 12000000)), make_name(rng),
+            rng.choice((u'duplicate', u'', u'not a populated place'))]
+
+
+def feature_row(rng, rownum):
+    feature_class, code = feature_code(rownum)
+    # Class and code are joined with a dot in these files
+    return [u'{}.{}'.format(feature_class, code), make_name(rng, (1, 2)),
+            make_name(rng, (3, 8)).lower()]
+
+
+def timezone_row(rng, rownum):
+    gmt_offset = rng.randint(-24, 28) / 2.0
+    return [country_code(rownum % NUM_COUNTRIES), timezone_id(rownum),
+            str(gmt_offset), str(gmt_offset + rng.randint(0, 1)),
+            str(gmt_offset)]
+
+
+def country_row(rng, rownum):
+    code = country_code(rownum)
+    neighbours = u','.join(country_code(rng.randrange(NUM_COUNTRIES))
+                           for _ in range(rng.randint(0, 6)))
+    return [code, code + u'X', u'{:03d}'.format(rownum), code,
+            make_name(rng, (1, 3)), make_name(rng, (1, 2)),
+            str(rng.randint(1, 17000000)), str(rng.randint(0, 1400000000)),
+            rng.choice(CONTINENTS), u'.' + code.lower(),
+            code + u'D', make_name(rng, (1, 1)),
+            str(rng.randint(1, 999)), u'#####', u'^(\\d{5})$',
+            u'{},en'.format(code.lower()), str(rng.randint(1, 12000000)),
+            neighbours, u'']
+
+
+# Reader class name: (file name, header lines, row function, rows or None
+# for `--rows`). Readers without field definitions have no entry.
+DUMPS = OrderedDict((
+    ('GeonameReader', ('allCountries.txt', (), geoname_row, None)),
+    ('GeonamePostalCodeReader',
+     (os.path.join('postal_codes', 'DE.txt'), (), postal_code_row, None)),
+    ('GeonameDeletesReader',
+     ('deletes-2020-01-01.txt', (), deletes_row, None)),
+    ('GeonameFeatureReader',
+     ('featureCodes_en.txt', (), feature_row, NUM_FEATURES)),
+    ('GeonameTimezoneReader',
+     ('timeZones.txt', (u'CountryCode\tTimeZoneId\tGMT offset 1. Jan 2013'
+                        u'\tDST offset 1. Jul 2013\trawOffset',),
+      timezone_row, NUM_TIMEZONES)),
+    ('GeonameCountryInfoReader',
+     ('countryInfo.txt', (u'# GeoNames.org Country Information',
+                          u'#ISO\tISO3\tISO-Numeric\tfips\tCountry'),
+      country_row, NUM_COUNTRIES)),
+))
+
+
+def write_dump(reader_name, directory, num_rows, seed=0):
+    """Writes the dump read by `reader_name` into `directory` and returns
+    its path. Files with one row per country, timezone and feature code
+    always get as many as there are.
+    """
+    filename, headers, make_row, fixed_rows = DUMPS[reader_name]
+    filepath = os.path.join(directory, filename)
+    if not os.path.isdir(os.path.dirname(filepath)):
+        os.makedirs(os.path.dirname(filepath))
+    rng = random.Random(u'{}:{}'.format(seed, reader_name))
+    with io.open(filepath, 'w', encoding='utf-8', newline='\n') as fh:
+        for header in headers:
+            fh.write(header + u'\n')
+        for rownum in range(fixed_rows or num_rows):
+            fh.write(u'\t'.join(make_row(rng, rownum)) + u'\n')
+    return filepath
+
+
+def write_dumps(directory, num_rows, seed=0, reader_names=None):
+    """Writes the dumps of `reader_names`, all by default. Returns a dict
+    of reader name to file path.
+    """
+    return OrderedDict(
+        (reader_name, write_dump(reader_name, directory, num_rows, seed))
+        for reader_name in reader_names or DUMPS)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory')
+    parser.add_argument('-n', '--rows', type=int, default=100000,
+                        help='Rows of the geoname, postal code and deletes '
+                             'files')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-r', '--reader', action='append',
+                        choices=list(DUMPS),
+                        help='Only write the dump of the given reader(s)')
+    args = parser.parse_args()
+    for reader_name, filepath in write_dumps(args.directory, args.rows,
+                                             args.seed,
+                                             args.reader).items():
+        print(u'{:<26} {}'.format(reader_name, filepath))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,9 +11,20 @@ if not PY2:
     text_type = str
     string_types = (str,)
     implements_to_string = _identity
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    def reraise(tp, value, tb=None):
+        if value.__traceback__ is not tb:
+            raise value.with_traceback(tb)
+        raise value
 else:
     text_type = unicode  # noqa
     string_types = (str, unicode)  # noqa
+    import Queue as queue  # noqa
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # noqa
+
+    exec('def reraise(tp, value, tb=None):\n raise tp, value, tb')
 
 
     def implements_to_string(cls):
@@ -35,3 +46,15 @@ else:
     import decimal
 
 Decimal = decimal.Decimal
+
+# NumPy is optional. Used for columnar reading of data dumps.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# resource is only available on Unix. Used to report peak memory usage.
+try:
+    import resource
+except ImportError:
+    resource = None
@@ -0,0 +1,125 @@
+"""Runtime tuning of the number of rows written per INSERT batch
+
+The best batch size depends on the table. Narrow tables like the feature
+table gain from big batches, while batches of wide geoname rows with
+geography points soon stop getting faster and just use more memory.
+"""
+from __future__ import absolute_import
+
+import sys
+
+from sqlalchemy_geonames import log
+
+logger = log.get_logger()
+
+# Limits of tuned batch sizes
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 50000
+
+# Default limit of the memory held by the rows of a batch
+MAX_BATCH_MEMORY = 64 * 1024 * 1024
+
+# Rows sampled to estimate the memory used per row
+ROW_SIZE_SAMPLE = 20
+
+
+def estimate_row_size(rows):
+    """Average bytes held by each of `rows` (dicts), including the values"""
+    sample = rows[:ROW_SIZE_SAMPLE]
+    if not sample:
+        return 0
+    total = 0
+    for row in sample:
+        total += sys.getsizeof(row)
+        total += sum(sys.getsizeof(value) for value in row.values())
+    return total // len(sample)
+
+
+class BatchSizer(object):
+    """Hill-climbs towards the batch size writing the most rows per second
+
+    The size is doubled or halved after each measured batch, in the same
+    direction as long as rows/sec improves and in the other direction when
+    it gets worse. After `max_reversals` reversals the best size measured
+    is kept. Sizes never exceed what fits in `max_memory`, estimated from
+    the first batch.
+    """
+
+    # Relative improvement of rows/sec needed to keep going
+    min_gain = 0.05
+
+    max_reversals = 3
+
+    def __init__(self, initial=500, minimum=MIN_BATCH_SIZE,
+                 maximum=MAX_BATCH_SIZE, max_memory=MAX_BATCH_MEMORY,
+                 name=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_memory = max_memory
+        # Name of what is being written, used in log messages
+        self.name = name
+        # Estimated bytes per row, measured on the first batch
+        self.row_size = None
+        self.size = self.limit(initial)
+        self.settled = False
+        # Best rows/sec measured for each size
+        self.rates = {}
+        self.growing = True
+        self.reversals = 0
+        self.last_rate = None
+
+    def limit(self, size):
+        """`size` within the limits of the batch size"""
+        maximum = self.maximum
+        if self.max_memory and self.row_size:
+            maximum = min(maximum, self.max_memory // self.row_size)
+        return max(self.minimum, min(maximum, size))
+
+    def record(self, rows, seconds):
+        """Records that writing `rows` took `seconds` and picks the size of
+        the next batch
+        """
+        if self.settled or len(rows) < self.size:
+            # The last batch of a file is usually smaller, which says
+            # nothing about the size
+            return
+        if self.row_size is None:
+            self.row_size = estimate_row_size(rows) or None
+        rate = len(rows) / max(seconds, 1e-6)
+        self.rates[self.size] = max(rate, self.rates.get(self.size, 0))
+        if (self.last_rate is not None and
+                rate < self.last_rate * (1 + self.min_gain)):
+            self.growing = not self.growing
+            self.reversals += 1
+        self.last_rate = rate
+        if self.reversals >= self.max_reversals:
+            self.settle()
+            return
+        size = self.limit(self.size * 2 if self.growing else self.size // 2)
+        if size == self.size:
+            # Hit a limit, go the other way
+            self.growing = not self.growing
+            self.reversals += 1
+            size = self.limit(self.size * 2 if self.growing
+                              else self.size // 2)
+        self.size = size
+
+    def settle(self):
+        """Keeps the size with the best measured rows/sec from now on"""
+        self.size = self.limit(max(self.rates, key=self.rates.get))
+        self.settled = True
+        logger.info(u'Batch size for {} settled on {} rows ({:.0f} rows/s)'
+                    u''.format(self.name, self.size,
+                               self.rates.get(self.size, 0)))
+
+
+class FixedBatchSizer(object):
+    """Batch size set by the user, never tuned"""
+
+    settled = True
+
+    def __init__(self, size):
+        self.size = size
+
+    def record(self, rows, seconds):
+        pass
@@ -25,12 +25,19 @@ import requests
 # noinspection PyPackageRequirements
 from progressbar import ProgressBar, ETA, FileTransferSpeed, Percentage, Bar
 
+from sqlalchemy_geonames import settings
+from sqlalchemy_geonames.downloads import download_files, \
+    DEFAULT_WORKERS as DEFAULT_DOWNLOAD_WORKERS
 from sqlalchemy_geonames.sqla import PASSWORD_NOT_SET, config
-from sqlalchemy_geonames.files import filename_config
+from sqlalchemy_geonames.files import filename_config, full_url, \
+    modifications_filename, deletes_filename
+from sqlalchemy_geonames.reader import RowFilter
 from sqlalchemy_geonames.sqla import create_geoname_tables, \
-    purge_geoname_tables
+    purge_geoname_tables, drop_geoname_constraints, \
+    create_geoname_constraints, set_geoname_tables_logged, \
+    analyze_geoname_tables, swap_geoname_schema, FAST_LOAD_SESSION_SETTINGS
 # noinspection PyProtectedMember
-from sqlalchemy_geonames.utils import normalize_path, mkdir_p
+from sqlalchemy_geonames.utils import normalize_path
 
 
 class RawArgumentDefaultsHelpFormatter(argparse.ArgumentDefaultsHelpFormatter,
@@ -49,6 +56,22 @@ LANGUAGE_CHOICES = sorted(set(opts['language_code'] for name, opts
                               if 'language_code' in opts))
 
 
+def comma_separated(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def bounding_box(value):
+    try:
+        bbox = [float(item) for item in value.split(',')]
+    except ValueError:
+        bbox = []
+    if len(bbox) != 4:
+        raise argparse.ArgumentTypeError(
+            u'Expected MIN_LAT,MIN_LON,MAX_LAT,MAX_LON, got "{}"'.format(
+                value))
+    return bbox
+
+
 def get_progress_bar(maxval):
     widgets = [Percentage(), ' ', Bar(), ' ', ETA(), ' ', FileTransferSpeed()]
     return ProgressBar(widgets=widgets, maxval=maxval)
@@ -63,7 +86,7 @@ def get_download_config(primary_filename, language_code=DEFAULT_LANGUAGE_CODE):
     supported_filenames = _import_options_map.keys()
     download_config = {k: v for k, v in deepcopy(filename_config).items()
                        if k in supported_filenames}
-    for filename, opts in download_config.items():
+    for filename, opts in list(download_config.items()):
         # Only download the selected primary primary_filename file
         if (filename in PRIMARY_GEONAME_FILENAMES and
                     filename != primary_filename):
@@ -75,48 +98,44 @@ def get_download_config(primary_filename, language_code=DEFAULT_LANGUAGE_CODE):
     return download_config
 
 
-def download(opts, download_dir=DEFAULT_DOWNLOAD_DIR, use_cache=True,
-             chunk_size=1024):
-    def _download(url, download_dir, use_cache, chunk_size=1024):
-        base_url, _, download_filename = url.rpartition('/')
-        local_filepath = get_local_filepath(download_filename, download_dir)
-        if use_cache and os.path.exists(local_filepath):
-            print(u'Using cached file {}'.format(local_filepath))
-            return local_filepath
-        else:
-            print(u'Downloading {} to {}...'.format(download_filename,
-                                                    local_filepath))
-        req = requests.get(url, stream=True)
-        req.raise_for_status()
-        content_length = int(req.headers['content-length'])
-        pbar = get_progress_bar(maxval=content_length)
-        pbar.start()
-        mkdir_p(download_dir)  # Make sure path exists
-        with open(local_filepath, 'wb') as fh:
-            for chunk in req.iter_content(chunk_size=chunk_size):
-                if not chunk:
-                    import pdb
-                    pdb.set_trace()
-                if chunk:  # Filter out keep-alive new chunks
-                    fh.write(chunk)
-                    fh.flush()
-                new_pbar_val = pbar.value + chunk_size
-                if new_pbar_val <= pbar.max_value:
-                    pbar.update(new_pbar_val)
-        pbar.finish()
-        print()
-        return local_filepath
+def get_progress_callback():
+    """Shows the progress of downloads done one at a time in progress bars"""
+    pbars = []
 
-    local_filepaths = [_download(opts['url'], download_dir=download_dir,
-                                 use_cache=use_cache, chunk_size=chunk_size)]
+    def progress(written, size):
+        if size is None:
+            return
+        if not pbars:
+            pbars.append(get_progress_bar(maxval=size))
+            pbars[0].start()
+        pbars[0].update(written)
+        if written == size:
+            pbars.pop().finish()
+    return progress
 
+
+def get_downloads(opts, download_dir=DEFAULT_DOWNLOAD_DIR):
+    """`(url, local filepath)` of the files to download for `opts`"""
+    downloads = [(opts['url'], get_local_filepath(
+        opts['url'].rpartition('/')[2], download_dir))]
     if 'postal_codes_url' in opts:
-        local_filepaths.append(
-            _download(opts['postal_codes_url'],
-                      download_dir=os.sep.join([download_dir, 'postal_codes']),
-                      use_cache=use_cache, chunk_size=chunk_size))
+        downloads.append((opts['postal_codes_url'], get_local_filepath(
+            opts['postal_codes_url'].rpartition('/')[2],
+            os.path.join(download_dir, 'postal_codes'))))
+    return downloads
+
 
-    return local_filepaths
+def download_all(downloads, use_cache=False,
+                 workers=DEFAULT_DOWNLOAD_WORKERS):
+    """Downloads `(url, local filepath)` pairs and returns the filepaths,
+    see `downloads`
+    """
+    progress = None
+    if workers == 1 or len(downloads) == 1:
+        # Progress bars of downloads running at the same time would mix
+        progress = get_progress_callback()
+    download_files(downloads, use_cache, workers, progress=progress)
+    return [filepath for url, filepath in downloads]
 
 
 def unzip(zip_filepath, filename_to_extract, extract_dir=DEFAULT_DOWNLOAD_DIR):
@@ -127,41 +146,229 @@ def unzip(zip_filepath, filename_to_extract, extract_dir=DEFAULT_DOWNLOAD_DIR):
     return zipfile.extract(member=filename_to_extract, path=extract_dir)
 
 
-def run_importers(db_session, download_dir, local_filepaths):
+def run_importers(db_session, download_dir, local_filepaths,
+                  write_method=None, jobs=1, pipelined=False, schema=None,
+                  archive_paths=None, row_filter=None, batch_size=None,
+                  max_batch_memory=None, transaction_policy=None,
+                  commit_every=None, skip_bad_rows=False, workers=1,
+                  resume=False, profile=False, profile_dump=None,
+                  profile_table='geoname'):
+    """Runs importers for `local_filepaths`
+
+    Files found in `archive_paths` (filepath to zip archive path) are read
+    straight from the archive. Only rows meeting `row_filter` are imported
+    into the geoname and postal code tables. Up to `workers` importers run
+    at the same time, see `scheduling`. With the `run` transaction policy
+    all files are imported one at a time in one transaction. With `resume`
+    files are imported from where the last import of them stopped. With
+    `profile` a summary of where the time went is printed, see
+    `instrumentation`, and with `profile_dump` a cProfile dump of the
+    importer of `profile_table` is written to that path. Returns a list of
+    `(table name, seconds)` for each importer.
+    """
+    from sqlalchemy_geonames import scheduling, instrumentation
     from sqlalchemy_geonames.imports import get_importer_instances
-    for importer in get_importer_instances(db_session, download_dir,
-                                           *local_filepaths):
-        print("Running importer for {}...".format(importer.filename))
-        importer.run()
+    connection = None
+    if workers > 1 and jobs > 1:
+        # Forking while other importer threads hold locks or connections
+        # can deadlock the worker processes
+        raise Exception(u'--jobs and --workers can not both be more than 1')
+    if transaction_policy == 'run':
+        if workers > 1:
+            raise Exception(u'Importers sharing one transaction can not '
+                            u'run at the same time, use --workers 1')
+        connection = db_session.bind.connect()
+        transaction = connection.begin()
+    try:
+        importers = get_importer_instances(
+            db_session, download_dir, *local_filepaths,
+            write_method=write_method, jobs=jobs, pipelined=pipelined,
+            schema=schema, archive_paths=archive_paths,
+            row_filter=row_filter, batch_size=batch_size,
+            max_batch_memory=max_batch_memory,
+            transaction_policy=transaction_policy,
+            commit_every=commit_every, skip_bad_rows=skip_bad_rows,
+            connection=connection, resume=resume)
+        if profile_dump is not None:
+            for importer in importers:
+                if importer.table.name == profile_table:
+                    importer.profile_path = profile_dump
+        finished = scheduling.run_importers(importers, workers)
+        timings = [(importer.table.name, seconds)
+                   for importer, seconds in finished]
+        if connection is not None:
+            transaction.commit()
+    finally:
+        # Closing rolls back the transaction unless committed
+        if connection is not None:
+            connection.close()
+    if profile:
+        print()
+        for line in instrumentation.format_stats(
+                [importer.stats for importer, seconds in finished]):
+            print(line)
+    return timings
+
+
+def apply_updates(db_session, download_dir, use_cache=False,
+                  download_workers=DEFAULT_DOWNLOAD_WORKERS):
+    """Downloads and applies the daily updates since the last import"""
+    from sqlalchemy_geonames import updates
+    pending_days = updates.get_pending_days(db_session)
+    if not pending_days:
+        print('Already up to date.')
+        return
+    day_filepaths = []
+    downloads = []
+    for day in pending_days:
+        filenames = (modifications_filename(day), deletes_filename(day))
+        day_filepaths.append((day, [get_local_filepath(filename, download_dir)
+                                    for filename in filenames]))
+        downloads.extend(zip([full_url(filename) for filename in filenames],
+                             day_filepaths[-1][1]))
+    try:
+        download_all(downloads, use_cache, download_workers)
+    except requests.HTTPError as exc:
+        raise Exception(u'Could not download {} ({}). Do a full import to '
+                        u'get up to date.'.format(exc.response.url, exc))
+    for day, filepaths in day_filepaths:
+        updates.apply_day(db_session, day, *filepaths)
+
+
+def print_timings(timings):
+    """Prints a table of `(phase, table name, seconds)` tuples"""
+    print()
+    print(u'{:<12} {:<20} {:>10}'.format('Phase', 'Table', 'Seconds'))
+    for phase, table_name, seconds in timings:
+        print(u'{:<12} {:<20} {:>10.2f}'.format(phase, table_name, seconds))
 
 
 def download_and_import(filename, database_type, database, schema, username,
                         password=None, port=None, host='localhost',
                         use_cache=False, download_dir=DEFAULT_DOWNLOAD_DIR,
                         language_code=DEFAULT_LANGUAGE_CODE,
-                        keep_existing_data=False, recreate_tables=False):
+                        keep_existing_data=False, recreate_tables=False,
+                        write_method=None, jobs=1, pipelined=False,
+                        defer_constraints=False, fast_load=False,
+                        shadow_schema=None, incremental=False,
+                        countries=None, feature_classes=None,
+                        feature_codes=None, min_population=None, bbox=None,
+                        batch_size=None, batch_memory=None, transaction=None,
+                        commit_every=None, skip_bad_rows=False, workers=1,
+                        resume=False, profile=False, profile_dump=None,
+                        profile_table='geoname',
+                        download_workers=DEFAULT_DOWNLOAD_WORKERS):
 
     config.update(schema_name=schema, database_type=database_type,
                   database=database, username=username, password=password,
                   port=port, host=host)
+    if fast_load:
+        config.session_settings = FAST_LOAD_SESSION_SETTINGS
 
     db_session = config.get_db_session()
 
+    max_batch_memory = batch_memory * 1024 * 1024 if batch_memory else None
+    row_filter = RowFilter(country_codes=countries,
+                           feature_classes=feature_classes,
+                           feature_codes=feature_codes,
+                           min_population=min_population, bbox=bbox)
+
     download_dir = normalize_path(download_dir)
+    if resume:
+        # Checkpoints are byte offsets in the files downloaded before
+        use_cache = True
+    if incremental:
+        if row_filter:
+            # Updates would bring back rows that were filtered out
+            raise Exception(u'Filters can not be used with --incremental')
+        apply_updates(db_session, download_dir, use_cache, download_workers)
+        return
+
+    # Updates hold modifications of all geonames, which only apply to the
+    # data of an import of all of them
+    full_import = filename == 'allCountries.txt' and not row_filter
     download_config = get_download_config(filename, language_code)
+    # Download all files at once before importing any of them
+    downloads = {filename: get_downloads(opts, download_dir)
+                 for filename, opts in download_config.items()}
+    download_all([download_ for filename in download_config
+                  for download_ in downloads[filename]], use_cache,
+                 download_workers)
     local_filepaths = []
+    archive_paths = {}
     for filename, opts in download_config.items():
-        for local_filepath in download(opts, download_dir, use_cache):
-            if opts.get('unzip') is True:
+        for url, local_filepath in downloads[filename]:
+            if opts.get('unzip') is True and jobs > 1:
+                # Importing in parallel needs random access to the file
                 local_filepath = unzip(
                     local_filepath, filename_to_extract=filename,
                     extract_dir=os.path.dirname(local_filepath))
+            elif opts.get('unzip') is True:
+                archive_path = local_filepath
+                local_filepath = os.path.join(os.path.dirname(archive_path),
+                                              filename)
+                archive_paths[local_filepath] = archive_path
             local_filepaths.append(local_filepath)
 
-    create_geoname_tables(db_session, recreate_tables=recreate_tables)
-    if not keep_existing_data:
-        purge_geoname_tables(db_session)
-    run_importers(db_session, download_dir, local_filepaths)
+    if resume:
+        # Keep the rows and checkpoints of the import being resumed
+        create_geoname_tables(db_session, schema=shadow_schema)
+    elif shadow_schema:
+        # Load into fresh tables in the shadow schema and swap them in when
+        # done, so the live tables are never purged or half filled.
+        create_geoname_tables(db_session, recreate_tables=True,
+                              schema=shadow_schema)
+    else:
+        create_geoname_tables(db_session, recreate_tables=recreate_tables)
+        if not keep_existing_data:
+            purge_geoname_tables(db_session)
+    timings = []
+    if fast_load:
+        # Making a table UNLOGGED rewrites it, which also gets rid of the
+        # rows just purged.
+        timings.extend(('unlogged', name, seconds) for name, seconds
+                       in set_geoname_tables_logged(db_session, logged=False,
+                                                    schema=shadow_schema))
+    # Tables made UNLOGGED are made LOGGED again even if the import fails,
+    # so they aren't left to be truncated after a crash.
+    try:
+        if defer_constraints:
+            drop_geoname_constraints(db_session, schema=shadow_schema)
+        import_timings = run_importers(
+            db_session, download_dir, local_filepaths,
+            write_method=write_method, jobs=jobs, pipelined=pipelined,
+            schema=shadow_schema, archive_paths=archive_paths,
+            row_filter=row_filter, batch_size=batch_size,
+            max_batch_memory=max_batch_memory,
+            transaction_policy=transaction, commit_every=commit_every,
+            skip_bad_rows=skip_bad_rows, workers=workers, resume=resume,
+            profile=profile, profile_dump=profile_dump,
+            profile_table=profile_table)
+        timings.extend(('import', name, seconds)
+                       for name, seconds in import_timings)
+        if defer_constraints:
+            create_geoname_constraints(db_session, schema=shadow_schema)
+    finally:
+        if fast_load:
+            timings.extend(('logged', name, seconds) for name, seconds
+                           in set_geoname_tables_logged(db_session,
+                                                        schema=shadow_schema))
+            timings.extend(('analyze', name, seconds) for name, seconds
+                           in analyze_geoname_tables(db_session,
+                                                     schema=shadow_schema))
+            print_timings(timings)
+    # The data includes all updates published so far, which incremental
+    # updates continue from. They would add geonames to partial data.
+    from sqlalchemy_geonames import updates
+    with db_session.bind.begin() as connection:
+        if full_import:
+            updates.set_last_updated(connection,
+                                     updates.get_latest_update_day(),
+                                     schema=shadow_schema)
+        else:
+            updates.clear_last_updated(connection, schema=shadow_schema)
+    if shadow_schema:
+        swap_geoname_schema(db_session, shadow_schema)
 
 
 def main():
@@ -190,10 +397,17 @@ def main():
                         help='Database host', default='localhost')
     parser.add_argument('-c', '--use-cache',
                         help="Use previously downloaded files if they exist "
-                             "in the download directory",
+                             "in the download directory, without checking "
+                             "whether they have changed",
                         action='store_const', const=True, default=False)
     parser.add_argument('-D', '--download-dir', default=DEFAULT_DOWNLOAD_DIR,
                         help='Where to download the data files')
+    parser.add_argument('--download-workers', type=int,
+                        default=DEFAULT_DOWNLOAD_WORKERS,
+                        help="Number of files to download at the same time."
+                             " Interrupted downloads are resumed and files"
+                             " that haven't changed since they were"
+                             " downloaded are skipped.")
     parser.add_argument('-l', '--language-code', default=DEFAULT_LANGUAGE_CODE,
                         choices=LANGUAGE_CHOICES, help='Feature data language')
     parser.add_argument('-k', '--keep-existing-data', action='store_const',
@@ -205,6 +419,125 @@ def main():
     parser.add_argument('-r', '--recreate-tables', action='store_const',
                         default=False, const=True,
                         help="Recreate geoname* tables.")
+    parser.add_argument('-w', '--write-method', choices=settings.WRITE_METHODS,
+                        default=None,
+                        help="How rows are written to the database. `copy`"
+                             " and `binary_copy` stream rows with COPY FROM"
+                             " STDIN in text or binary format, `insert` uses"
+                             " batched INSERTs. Defaults to what each"
+                             " importer prefers (binary_copy for the geoname"
+                             " and postal code tables).")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of processes to import the geoname and"
+                             " postal code files with. Each process imports"
+                             " a part of the file over its own database"
+                             " connection.")
+    parser.add_argument('-W', '--workers', type=int, default=1,
+                        help="Number of importers to run at the same time,"
+                             " each over its own database connection."
+                             " Importers start as soon as the tables they"
+                             " refer to are loaded. Can not be combined with"
+                             " --jobs.")
+    parser.add_argument('-i', '--pipelined', action='store_const',
+                        default=False, const=True,
+                        help="Write rows to the database in a separate"
+                             " thread while the next rows are parsed.")
+    parser.add_argument('-C', '--defer-constraints', action='store_const',
+                        default=False, const=True,
+                        help="Drop primary keys, foreign keys and spatial"
+                             " indexes before importing and build them once"
+                             " all data is loaded. Rows violating a"
+                             " constraint are reported at the end. If the"
+                             " import fails, run again with this option to"
+                             " get the constraints back.")
+    parser.add_argument('-F', '--fast-load', action='store_const',
+                        default=False, const=True,
+                        help="Load into UNLOGGED tables with"
+                             " synchronous_commit off and more"
+                             " maintenance_work_mem, then make the tables"
+                             " LOGGED and ANALYZE them. Data loaded so far is"
+                             " lost if the database crashes during the"
+                             " import. Prints timings for each phase.")
+    parser.add_argument('-S', '--shadow-schema', default=None,
+                        help="Load into new tables in this schema and swap"
+                             " them with the tables in --schema in one"
+                             " transaction once the import is done. Readers"
+                             " of the old tables keep seeing the old data"
+                             " until then. The schema is created if missing"
+                             " and dropped after the swap.")
+    parser.add_argument('-I', '--incremental', action='store_const',
+                        default=False, const=True,
+                        help="Apply geonames' daily modifications and"
+                             " deletes since the last import or update"
+                             " instead of importing everything. Meant for"
+                             " databases loaded from allCountries.txt.")
+    parser.add_argument('-R', '--resume', action='store_const',
+                        default=False, const=True,
+                        help="Continue an import that was interrupted, from"
+                             " the last rows committed. Pass the same"
+                             " options as to the interrupted import. Files"
+                             " already imported are skipped and the"
+                             " downloaded files are reused. Files are"
+                             " continued from their last commit, so use"
+                             " --transaction rows to not start big files"
+                             " over.")
+    parser.add_argument('-b', '--batch-size', type=int, default=None,
+                        help="Rows per INSERT batch for the insert write"
+                             " method. Defaults to tuning the size while"
+                             " importing, from the measured rows/sec. Set"
+                             " SQLALCHEMY_GEONAMES_LOG_LEVEL=INFO to see"
+                             " the sizes chosen.")
+    parser.add_argument('-M', '--batch-memory', type=int, default=None,
+                        help="Max MB held by the rows of a tuned INSERT"
+                             " batch. Defaults to 64.")
+    parser.add_argument('-T', '--transaction', default=None,
+                        choices=settings.TRANSACTION_POLICIES,
+                        help="When imported rows are committed. `batch`"
+                             " after every INSERT batch or COPY, `rows`"
+                             " every --commit-every rows, `importer` once"
+                             " each file is imported and `run` once all"
+                             " files are. Defaults to `importer`, so a"
+                             " failed import leaves its table untouched.")
+    parser.add_argument('--commit-every', type=int, default=None,
+                        help="Rows per transaction with --transaction rows."
+                             " Defaults to 100000.")
+    parser.add_argument('--skip-bad-rows', action='store_const',
+                        default=False, const=True,
+                        help="Log and skip rows the database refuses"
+                             " instead of stopping the import. Failing"
+                             " INSERT batches are split up to find them.")
+    parser.add_argument('--profile', action='store_const', default=False,
+                        const=True,
+                        help="Print the time spent decoding, parsing,"
+                             " modifying and writing rows, rows/sec, batch"
+                             " latencies and peak memory of each importer.")
+    parser.add_argument('--profile-dump', default=None, metavar='PATH',
+                        help="Write a cProfile dump of the importer of"
+                             " --profile-table to PATH. Read it with the"
+                             " pstats module. With --jobs the work done in"
+                             " the worker processes isn't included.")
+    parser.add_argument('--profile-table', default='geoname',
+                        help="Table of the importer to profile with"
+                             " --profile-dump.")
+    filters = parser.add_argument_group(
+        'filters', "Only import the geonames and postal codes matching all"
+                   " of these. Rows are filtered as they are read, before"
+                   " being parsed. The country, feature and timezone tables"
+                   " are always imported in full.")
+    filters.add_argument('--countries', type=comma_separated, default=None,
+                         metavar='CC[,CC...]',
+                         help="ISO-3166 2-letter country codes")
+    filters.add_argument('--feature-classes', type=comma_separated,
+                         default=None, metavar='CLASS[,CLASS...]',
+                         help="Feature classes, e.g. P for populated places")
+    filters.add_argument('--feature-codes', type=comma_separated,
+                         default=None, metavar='CODE[,CODE...]',
+                         help="Feature codes, e.g. PPLC for capitals")
+    filters.add_argument('--min-population', type=int, default=None,
+                         help="Minimum population")
+    filters.add_argument('--bbox', type=bounding_box, default=None,
+                         metavar='MIN_LAT,MIN_LON,MAX_LAT,MAX_LON',
+                         help="Bounding box the points must be within")
 
     args = parser.parse_args()
     if args.no_password is True:
@@ -0,0 +1,98 @@
+"""Checkpoints of imports, for resuming them where they stopped
+
+Each range of a file being imported (the whole file unless it's imported
+in parallel) has a row in the `import_checkpoint` table. It is updated in
+the same transaction as the rows written, so it always tells from where in
+the file to continue: the byte offset and row number after the last rows
+read before the commit, and how many rows read from there were written too.
+Modifiers mustn't add or drop rows for the count to hold.
+"""
+from __future__ import absolute_import
+
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import select
+
+from sqlalchemy_geonames import models, sqla
+
+
+def _get_checkpoint_table(schema=None):
+    return sqla.get_geoname_table(models.GeonameImportCheckpoint.__table__,
+                                  schema)
+
+
+def start_checkpoints(connection, filename, ranges, schema=None):
+    """Replaces the checkpoints of `filename` with one at the start of each
+    of `ranges`, dicts of `start`, `end` and `start_rownum`
+    """
+    table = _get_checkpoint_table(schema)
+    connection.execute(table.delete().where(table.c.filename == filename))
+    updated = datetime.utcnow()
+    connection.execute(table.insert(), [
+        {'filename': filename, 'range_start': range_['start'],
+         'range_end': range_['end'], 'offset': range_['start'],
+         'rownum': range_['start_rownum'], 'skip_rows': 0,
+         'rows_written': 0, 'finished': False, 'updated': updated}
+        for range_ in ranges])
+
+
+def get_resume_ranges(connection, filename, schema=None):
+    """The unfinished ranges of `filename` to continue importing, or None if
+    it has no checkpoints
+
+    Ranges are dicts of `Importer.import_rows` arguments.
+    """
+    table = _get_checkpoint_table(schema)
+    checkpoints = connection.execute(
+        select([table]).where(table.c.filename == filename)
+        .order_by(table.c.range_start)).fetchall()
+    if not checkpoints:
+        return None
+    return [{'start': checkpoint.offset, 'end': checkpoint.range_end,
+             'start_rownum': checkpoint.rownum,
+             'skip_rows': checkpoint.skip_rows,
+             'range_start': checkpoint.range_start,
+             'rows_written': checkpoint.rows_written}
+            for checkpoint in checkpoints if not checkpoint.finished]
+
+
+def save_checkpoint(connection, filename, range_start, offset, rownum,
+                    skip_rows, rows_written, finished=False, schema=None):
+    """Records how far the range of `filename` at `range_start` got"""
+    table = _get_checkpoint_table(schema)
+    connection.execute(
+        table.update().where((table.c.filename == filename) &
+                             (table.c.range_start == range_start))
+        .values(offset=offset, rownum=rownum, skip_rows=skip_rows,
+                rows_written=rows_written, finished=finished,
+                updated=datetime.utcnow()))
+
+
+class ReadPositions(object):
+    """Positions in a file after batches of rows read from it
+
+    Rows are read ahead of the ones written, so the position is recorded
+    with the number of rows read so far to look up where to continue from
+    when some number of them have been written. Rows are read and written
+    in different threads when pipelined.
+    """
+
+    def __init__(self):
+        # `(rows read, byte offset, row number)`, oldest first
+        self.positions = deque()
+
+    def add(self, rows_read, position):
+        offset, rownum = position
+        self.positions.append((rows_read, offset, rownum))
+
+    def get(self, rows_written):
+        """Byte offset and row number to continue reading from and the
+        number of rows read from there that are written
+        """
+        positions = self.positions
+        # Positions older than the latest one reached are no longer needed
+        while len(positions) > 1 and positions[1][0] <= rows_written:
+            positions.popleft()
+        rows_read, offset, rownum = positions[0]
+        return offset, rownum, rows_written - rows_read
@@ -0,0 +1,167 @@
+"""Downloading the data files
+
+Files are downloaded in `workers` threads at a time, a few MB at a time.
+Each file is written to `<filepath>.part` first and moved in place once
+complete, so an interrupted download leaves the part behind and the next
+one continues from its end with a Range request.
+
+The ETag and Last-Modified headers of each download are kept in
+`<filepath>.headers`. They are sent back as If-None-Match and
+If-Modified-Since, so a file that hasn't changed on the server isn't
+downloaded again, and as If-Range when continuing a part, so a part of a
+file that has changed since is started over.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import io
+import json
+import os
+import re
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from sqlalchemy_geonames.utils import mkdir_p
+
+# Bytes read from the response and written to the file at a time
+CHUNK_SIZE = 4 * 1024 * 1024
+# Number of files downloaded at the same time by default
+DEFAULT_WORKERS = 4
+# Seconds to wait for the server to connect or send more data
+TIMEOUT = 60
+
+# What `download_file` did
+DOWNLOADED = 'downloaded'
+RESUMED = 'resumed'
+UNCHANGED = 'unchanged'
+CACHED = 'cached'
+
+
+def _read_headers(filepath):
+    """Headers kept for `filepath`, empty if there are none"""
+    try:
+        with io.open(filepath + '.headers', encoding='utf-8') as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_headers(filepath, headers):
+    with io.open(filepath + '.headers', 'w', encoding='utf-8') as fh:
+        fh.write(json.dumps(headers, ensure_ascii=False))
+
+
+def _remove_part(part_filepath):
+    for filepath in (part_filepath, part_filepath + '.headers'):
+        if os.path.exists(filepath):
+            os.remove(filepath)
+
+
+def _get_range_start(response):
+    """First byte of a partial response, None if it isn't one"""
+    match = re.match(r'bytes (\d+)-',
+                     response.headers.get('content-range', ''))
+    return int(match.group(1)) if match else None
+
+
+def download_file(url, filepath, use_cache=False, chunk_size=CHUNK_SIZE,
+                  timeout=TIMEOUT, progress=None):
+    """Downloads `url` to `filepath` unless it's there and unchanged
+
+    With `use_cache` a file already at `filepath` is used without asking
+    the server. `progress` is called with the bytes of the file written so
+    far and its size, if known, after each chunk. Returns one of
+    `DOWNLOADED`, `RESUMED`, `UNCHANGED` and `CACHED`.
+    """
+    filename = os.path.basename(filepath)
+    if use_cache and os.path.exists(filepath):
+        print(u'Using cached file {}'.format(filepath))
+        return CACHED
+    mkdir_p(os.path.dirname(filepath))
+    part_filepath = filepath + '.part'
+    # Byte offsets only hold for the file as stored on the server
+    request_headers = {'Accept-Encoding': 'identity'}
+    offset = 0
+    part_headers = _read_headers(part_filepath)
+    if os.path.exists(part_filepath) and part_headers.get('url') == url:
+        validator = part_headers.get('etag') or part_headers.get(
+            'last_modified')
+        if validator:
+            offset = os.path.getsize(part_filepath)
+            request_headers['Range'] = 'bytes={}-'.format(offset)
+            request_headers['If-Range'] = validator
+    elif os.path.exists(filepath):
+        headers = _read_headers(filepath)
+        if headers.get('url') == url:
+            if headers.get('etag'):
+                request_headers['If-None-Match'] = headers['etag']
+            if headers.get('last_modified'):
+                request_headers['If-Modified-Since'] = \
+                    headers['last_modified']
+
+    response = requests.get(url, headers=request_headers, stream=True,
+                            timeout=timeout)
+    try:
+        if response.status_code == 304:
+            print(u'{} is unchanged'.format(filename))
+            return UNCHANGED
+        if offset and (response.status_code == 416 or (
+                response.status_code == 206 and
+                _get_range_start(response) != offset)):
+            # The file got shorter than the part, or the server sent another
+            # range than the one asked for. Start over without a range.
+            response.close()
+            _remove_part(part_filepath)
+            return download_file(url, filepath, chunk_size=chunk_size,
+                                 timeout=timeout, progress=progress)
+        response.raise_for_status()
+        if offset and response.status_code != 206:
+            # The file has changed since the part was downloaded
+            offset = 0
+        if offset:
+            print(u'Resuming {} at {} bytes...'.format(filename, offset))
+        else:
+            print(u'Downloading {} to {}...'.format(filename, filepath))
+            _write_headers(part_filepath, {
+                'url': url, 'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified')})
+        size = None
+        if 'content-length' in response.headers:
+            size = offset + int(response.headers['content-length'])
+        written = offset
+        with open(part_filepath, 'ab' if offset else 'wb') as fh:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                fh.write(chunk)
+                written += len(chunk)
+                if progress is not None:
+                    progress(written, size)
+    finally:
+        response.close()
+    if size is not None and written != size:
+        raise IOError(u'Download of {} ended after {} of {} bytes, run '
+                      u'again to resume it'.format(url, written, size))
+    os.rename(part_filepath, filepath)
+    os.rename(part_filepath + '.headers', filepath + '.headers')
+    return RESUMED if offset else DOWNLOADED
+
+
+def download_files(downloads, use_cache=False, workers=DEFAULT_WORKERS,
+                   **kwargs):
+    """Downloads `(url, filepath)` pairs in up to `workers` threads
+
+    Returns what `download_file` did for each of `downloads`. The first
+    error is raised once the downloads already started are done.
+    `kwargs` are passed on to `download_file`.
+    """
+    if not downloads:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(downloads))))
+    try:
+        return pool.map(
+            lambda download: download_file(download[0], download[1],
+                                           use_cache, **kwargs),
+            downloads, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
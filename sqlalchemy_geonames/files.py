@@ -95,8 +95,14 @@ filename_config = {
     },
 }
 
-# TODO: Support modification files
-# alternateNamesDeletes-2013-12-16.txt
-# alternateNamesModifications-2013-12-16.txt
-# deletes-2013-12-16.txt
-# modifications-2013-12-16.txt
+
+# Daily incremental updates of allCountries.txt, see `updates`.
+# TODO: Support alternateNamesDeletes-YYYY-MM-DD.txt and
+#       alternateNamesModifications-YYYY-MM-DD.txt once alternate names are
+#       imported.
+def modifications_filename(day):
+    return 'modifications-{}.txt'.format(day.isoformat())
+
+
+def deletes_filename(day):
+    return 'deletes-{}.txt'.format(day.isoformat())
@@ -1,9 +1,17 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from sqlalchemy_geonames import reader, models, settings
+import os
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+
+from sqlalchemy_geonames import reader, models, settings, pgcopy, parallel, \
+    pipeline, sqla, batching, transactions, scheduling, checkpoints, \
+    instrumentation
 # noinspection PyProtectedMember
 from sqlalchemy_geonames._compat import implements_to_string
+from sqlalchemy_geonames.utils import batched
 
 
 # See note in _compat for why decimal is imported
@@ -12,15 +20,31 @@ from sqlalchemy_geonames._compat import implements_to_string
 @implements_to_string
 class Importer(object):
 
+    # Rows per INSERT batch to start tuning from, see `batching.BatchSizer`
     num_simoultaneous_inserts = 500
 
+    # Number of rows passed to the modifiers at a time
+    modifier_batch_size = 1000
+
+    # Max number of batches of `num_simoultaneous_inserts` rows waiting for
+    # the writer thread when `pipelined` is enabled.
+    pipeline_max_batches = 4
+
     def __str__(self):
         return '<{}Importer: {}>'.format(self.model.__name__,
                                          self.filename)
     __repr__ = __str__
 
-    def __init__(self, options, filepath, session, download_dir):
+    def __init__(self, options, filepath, session, download_dir,
+                 write_method=None, jobs=1, pipelined=False, schema=None,
+                 archive_path=None, row_filter=None, batch_size=None,
+                 max_batch_memory=None, transaction_policy=None,
+                 commit_every=None, skip_bad_rows=False, connection=None,
+                 resume=False, profile_path=None):
         self.filepath = filepath
+        # Zip archive to read the file from, instead of from `filepath`
+        self.archive_path = archive_path
+        self.download_dir = download_dir
         self.filename = _get_import_filename(filepath, download_dir)
         self.session = session
         self.engine = session.bind
@@ -28,22 +52,67 @@ class Importer(object):
         self.options = options
         self.file_class = options.file_class
         self.model = options.model
-        self.table = self.model.__table__
-        self.modifiers = options.modifiers
+        # Rows are written to `schema` instead of the models' schema if given
+        self.schema = schema
+        self.table = sqla.get_geoname_table(self.model.__table__, schema)
         self.model_dependencies = options.model_dependencies
-
-    def __lt__(self, other):
-        """For sorting a list of importers in the order they should run"""
-        return self.model in other.model_dependencies
-
-    def __gt__(self, other):
-        return not self.__lt__(other)
-
-    def store_rows(self):
+        self.write_method = write_method or options.write_method
+        if self.write_method not in settings.WRITE_METHODS:
+            raise ValueError(u'Unknown write method "{}"'.format(
+                self.write_method))
+        modifiers = options.modifiers
+        if self.write_method == 'binary_copy':
+            modifiers = [_binary_copy_modifiers.get(m, m) for m in modifiers]
+        self.modifiers = [as_batch_modifier(m) for m in modifiers]
+        # Fields of the file to parse, None for all of them
+        self.fields = get_import_fields(self.file_class, self.table,
+                                        modifiers)
+        # Number of processes to import with. Only used for importers whose
+        # options allow it, the other files are too small to gain from it.
+        self.jobs = jobs if options.parallel else 1
+        if self.jobs > 1 and archive_path is not None:
+            raise ValueError(u'Files in zip archives can not be imported in '
+                             u'parallel, extract {} first'.format(
+                                 self.filename))
+        # Parse in this thread while a writer thread writes to the database
+        self.pipelined = pipelined
+        # A `reader.RowFilter` selecting the rows to import. Only applied to
+        # the files of options that allow it.
+        self.row_filter = row_filter if options.filterable else None
+        # Fixed number of rows per INSERT batch, tuned at runtime if None
+        self.batch_size = batch_size or options.batch_size
+        self.max_batch_memory = max_batch_memory or options.max_batch_memory
+        # When to commit, one of `settings.TRANSACTION_POLICIES`
+        self.transaction_policy = (transaction_policy or
+                                   options.transaction_policy)
+        self.commit_every = commit_every or options.commit_every
+        if self.transaction_policy not in settings.TRANSACTION_POLICIES:
+            raise ValueError(u'Unknown transaction policy "{}"'.format(
+                self.transaction_policy))
+        # Log and skip rows that can't be inserted instead of failing
+        self.skip_bad_rows = skip_bad_rows
+        # Connection to write over, in a transaction begun by the caller.
+        # Used with the `run` policy to import all files in one transaction.
+        self.connection = connection
+        if self.transaction_policy == 'run' and self.jobs > 1:
+            raise ValueError(u'Files imported in parallel can not be '
+                             u'written in one transaction with the rest')
+        # Continue from the checkpoints of an earlier import of the file
+        self.resume = resume
+        # Timings of the import, see `instrumentation`
+        self.stats = instrumentation.ImportStats(self.table.name)
+        # Write a cProfile dump of the import to this path if given
+        self.profile_path = profile_path
+
+    def store_rows(self, connection, transaction, batch_sizer=None):
         if not self.stored_rows:
             return
+        rows = self.stored_rows
         try:
-            self.engine.execute(self.table.insert(), self.stored_rows)
+            with self.stats.timer('write') as timing:
+                transactions.execute_batch(connection, self.table.insert(),
+                                           rows,
+                                           skip_bad_rows=self.skip_bad_rows)
         except Exception as exc:
             if settings.DEBUG:
                 print(exc)
@@ -53,36 +122,324 @@ class Importer(object):
                 raise
         finally:
             self.stored_rows = []
+        self.stats.record_batch(len(rows), timing.seconds)
+        transaction.rows_written(len(rows))
+        if batch_sizer is not None:
+            batch_sizer.record(rows, timing.seconds)
+
+    @contextmanager
+    def begin(self, checkpoint=None):
+        """Yields a connection and the `transactions.ImportTransaction`
+        committing what is written over it
+        """
+        if self.connection is not None:
+            connection = self.connection
+        else:
+            connection = self.engine.connect()
+        try:
+            with transactions.ImportTransaction(
+                    connection, self.transaction_policy,
+                    self.commit_every, checkpoint) as transaction:
+                yield connection, transaction
+        finally:
+            if connection is not self.connection:
+                connection.close()
+
+    def get_batch_sizer(self):
+        if self.batch_size:
+            return batching.FixedBatchSizer(self.batch_size)
+        return batching.BatchSizer(initial=self.num_simoultaneous_inserts,
+                                   max_memory=self.max_batch_memory,
+                                   name=self.table.name)
+
+    def get_reader(self, **reader_kwargs):
+        if self.options.coordinates is not None:
+            reader_kwargs.setdefault('coordinates', self.options.coordinates)
+        if self.fields is not None:
+            reader_kwargs.setdefault('fields', self.fields)
+        if self.row_filter:
+            reader_kwargs.setdefault('row_filter', self.row_filter)
+        reader_kwargs.setdefault('stats', self.stats)
+        if self.archive_path is not None:
+            return self.file_class(self.archive_path,
+                                   member=os.path.basename(self.filepath),
+                                   **reader_kwargs)
+        return self.file_class(self.filepath, **reader_kwargs)
+
+    def iter_batches(self, positions=None, skip_rows=0, **reader_kwargs):
+        """Batches of rows from the source file with all modifiers applied
+
+        `reader_kwargs` are passed on to `file_class`, e.g. to only read a
+        range of the file. The first `skip_rows` rows are skipped. The
+        position in the file after each batch is added to `positions`, a
+        `checkpoints.ReadPositions`, if given.
+        """
+        timer = self.stats.timer
+        file_reader = self.get_reader(**reader_kwargs)
+        rows = iter(file_reader)
+        if skip_rows:
+            with timer('parse'):
+                next(islice(rows, skip_rows, skip_rows), None)
+        rows_read = 0
+        if positions is not None:
+            positions.add(rows_read, file_reader.get_position())
+        batches = batched(rows, self.modifier_batch_size)
+        while True:
+            with timer('parse'):
+                batch = next(batches, None)
+            if batch is None:
+                return
+            if positions is not None:
+                rows_read += len(batch)
+                positions.add(rows_read, file_reader.get_position())
+            with timer('modify'):
+                for modifier in self.modifiers:
+                    batch = modifier(self.session, self.model, batch)
+            yield batch
+
+    def iter_rows(self, **kwargs):
+        """Rows from the source file with all modifiers applied"""
+        for batch in self.iter_batches(**kwargs):
+            for row in batch:
+                yield row
+
+    def insert_rows(self, rows, checkpoint=None):
+        batch_sizer = self.get_batch_sizer()
+        with self.begin(checkpoint) as (connection, transaction):
+            for row in rows:
+                self.stored_rows.append(row)
+                if len(self.stored_rows) >= batch_sizer.size:
+                    self.store_rows(connection, transaction, batch_sizer)
+            self.store_rows(connection, transaction, batch_sizer)
+        if not batch_sizer.settled and batch_sizer.rates:
+            # Too few batches to finish tuning, report the best one
+            batch_sizer.settle()
+
+    def copy_rows(self, rows, checkpoint=None):
+        encoder_class = _copy_encoders[self.write_method]
+        # One COPY per transaction with the `rows` policy, otherwise one for
+        # all rows.
+        chunk_size = (self.commit_every if self.transaction_policy == 'rows'
+                      else None)
+        rows = iter(rows)
+        with self.begin(checkpoint) as (connection, transaction):
+            while True:
+                # Rows are parsed while they are copied, which is timed
+                # separately unless pipelined.
+                with self.stats.timer('write') as timing:
+                    num_rows = pgcopy.copy_rows(connection, self.table,
+                                                islice(rows, chunk_size),
+                                                encoder_class=encoder_class)
+                if not num_rows:
+                    break
+                self.stats.record_batch(num_rows, timing.seconds)
+                transaction.rows_written(num_rows)
+
+    def write_rows(self, rows, checkpoint=None):
+        if self.write_method in _copy_encoders:
+            self.copy_rows(rows, checkpoint)
+        else:
+            self.insert_rows(rows, checkpoint)
+
+    def import_rows(self, range_start=None, skip_rows=0, rows_written=0,
+                    **reader_kwargs):
+        """Imports the rows of the file, or of the range given by
+        `reader_kwargs`, and records checkpoints of the range at
+        `range_start` as they are committed
+
+        The first `skip_rows` rows read are skipped and `rows_written` rows
+        of the range are already written, when resuming an import.
+        """
+        if range_start is None:
+            range_start = reader_kwargs.get('start', 0)
+        positions = checkpoints.ReadPositions()
+
+        def checkpoint(connection, num_rows, finished):
+            offset, rownum, skip = positions.get(num_rows)
+            checkpoints.save_checkpoint(
+                connection, self.filename, range_start, offset, rownum,
+                skip, rows_written + num_rows, finished, schema=self.schema)
+
+        rows = self.iter_rows(positions=positions, skip_rows=skip_rows,
+                              **reader_kwargs)
+        write_rows = partial(self.write_rows, checkpoint=checkpoint)
+        if self.pipelined:
+            pipeline.run_pipelined(rows, write_rows,
+                                   batch_size=self.num_simoultaneous_inserts,
+                                   max_batches=self.pipeline_max_batches)
+        else:
+            write_rows(rows)
+
+    def get_ranges(self):
+        """Ranges of the file to import, as dicts of `import_rows` arguments
+        """
+        if self.jobs > 1:
+            return [{'start': start, 'end': end, 'start_rownum': start_rownum}
+                    for start, end, start_rownum
+                    in parallel.get_line_ranges(self.filepath, self.jobs)]
+        return [{'start': 0, 'end': None, 'start_rownum': 0}]
 
     def run(self):
-        for i, row in enumerate(self.file_class(self.filepath)):
-            for modifier in self.modifiers:
-                row = modifier(self.session, self.model, row)
-            self.stored_rows.append(row)
-            if i % self.num_simoultaneous_inserts == 0:
-                self.store_rows()
-        self.store_rows()
+        with self.stats.measure():
+            if self.profile_path is not None:
+                instrumentation.run_profiled(self.profile_path,
+                                             self.import_file)
+            else:
+                self.import_file()
+
+    def import_file(self):
+        """Imports the file, or what is left of it when resuming"""
+        ranges = None
+        if self.resume:
+            with self.engine.connect() as connection:
+                ranges = checkpoints.get_resume_ranges(
+                    connection, self.filename, schema=self.schema)
+            if ranges == []:
+                print(u'{} is already imported'.format(self.filename))
+                return
+            if ranges is not None:
+                print(u'Resuming import of {}...'.format(self.filename))
+        if ranges is None:
+            ranges = self.get_ranges()
+            with self.begin() as (connection, transaction):
+                checkpoints.start_checkpoints(connection, self.filename,
+                                              ranges, schema=self.schema)
+        if self.jobs > 1 and len(ranges) > 1:
+            parallel.run_importer_in_parallel(self, ranges)
+        else:
+            for range_kwargs in ranges:
+                self.import_rows(**range_kwargs)
+
+
+def batch_modifier(func):
+    """Marks `func` as a batch modifier
+
+    Modifiers are either called with each row (a dict) and return the
+    modified row, or, if marked as batch modifiers, called with a list of
+    rows and return the modified list. Batch modifiers save a function call
+    per row and modifier.
+    """
+    func.is_batch_modifier = True
+    return func
+
+
+def uses_fields(*field_names):
+    """Declares the fields of the source file read by a modifier
 
+    Files are only parsed for the columns of the table and the fields used
+    by the modifiers, if all of them declare which ones they use.
+    """
+    def decorator(func):
+        func.uses_fields = field_names
+        return func
+    return decorator
+
+
+def as_batch_modifier(modifier):
+    """Adapts a per row modifier to be called with batches of rows"""
+    if getattr(modifier, 'is_batch_modifier', False):
+        return modifier
+
+    @batch_modifier
+    def modify_batch(session, model, rows):
+        return [modifier(session, model, row) for row in rows]
+    if hasattr(modifier, 'uses_fields'):
+        modify_batch.uses_fields = modifier.uses_fields
+    return modify_batch
+
+
+def get_import_fields(file_class, table, modifiers):
+    """Names of the fields of `file_class` needed to import into `table`
 
+    Returns None, meaning all fields, if the table has a column for each
+    field or a modifier doesn't declare the fields it uses.
+    """
+    needed = set(column.name for column in table.columns)
+    for modifier in modifiers:
+        field_names = getattr(modifier, 'uses_fields', None)
+        if field_names is None:
+            return None
+        needed.update(field_names)
+    all_fields = [key for key, type_def in file_class.field_definitions]
+    fields = [key for key in all_fields if key in needed]
+    return fields if len(fields) < len(all_fields) else None
+
+
+@uses_fields('latitude', 'longitude')
 def set_geopoint_modifier(session, model, row):
     row['point'] = u"POINT({0} {1})".format(row['latitude'],
                                             row['longitude'])
     return row
 
 
+@batch_modifier
+@uses_fields('latitude', 'longitude')
+def set_geopoints_modifier(session, model, rows):
+    format_point = u"POINT({0} {1})".format
+    for row in rows:
+        row['point'] = format_point(row['latitude'], row['longitude'])
+    return rows
+
+
+@uses_fields('latitude', 'longitude')
+def set_geopoint_coords_modifier(session, model, row):
+    # Same point as `set_geopoint_modifier` but without formatting it as
+    # WKT. The binary COPY encoder writes the coordinates as EWKB.
+    row['point'] = (row['latitude'], row['longitude'])
+    return row
+
+
+@batch_modifier
+@uses_fields('latitude', 'longitude')
+def set_geopoints_coords_modifier(session, model, rows):
+    for row in rows:
+        row['point'] = (row['latitude'], row['longitude'])
+    return rows
+
+
+# Foreign key columns of the geoname table that may be empty in the data
+_nullable_fk_colnames = ('feature_code', 'timezone_id', 'country_code')
+
+
+@uses_fields(*_nullable_fk_colnames)
 def clear_empty_fks_modifier(session, model, row):
     # Ensure empty foreign key fields is NULL instead of passing in empty
     # strings etc.
-    for colname in ('feature_code', 'timezone_id', 'country_code'):
+    for colname in _nullable_fk_colnames:
         if not row.get(colname):
             row[colname] = None
     return row
 
 
+@batch_modifier
+@uses_fields(*_nullable_fk_colnames)
+def clear_empty_fks_batch_modifier(session, model, rows):
+    # Batch version of `clear_empty_fks_modifier`. Few values are empty, so
+    # look for them column by column.
+    for colname in _nullable_fk_colnames:
+        for row in rows:
+            if not row.get(colname):
+                row[colname] = None
+    return rows
+
+
 def _get_import_filename(filepath, download_dir):
     return filepath.replace(download_dir, '')[1:]
 
 
+# Modifiers replaced with a cheaper equivalent for the `binary_copy` write
+# method.
+_binary_copy_modifiers = {
+    set_geopoint_modifier: set_geopoint_coords_modifier,
+    set_geopoints_modifier: set_geopoints_coords_modifier,
+}
+
+_copy_encoders = {
+    'copy': pgcopy.TextCopyEncoder,
+    'binary_copy': pgcopy.BinaryCopyEncoder,
+}
+
+
 @implements_to_string
 class ImportOptions(object):
 
@@ -100,8 +457,43 @@ class ImportOptions(object):
         raise NotImplemented('`model` must be specified')
 
     model_dependencies = []
+
+    # Functions modifying the rows read before they are written. Both per
+    # row and batch modifiers are supported, see `batch_modifier`.
     modifiers = []
 
+    # One of `settings.WRITE_METHODS`. Can be overridden for all importers
+    # with `sqlageonames --write-method`.
+    write_method = 'insert'
+
+    # Whether the file may be split up and imported by several processes,
+    # see `sqlageonames --jobs`.
+    parallel = False
+
+    # How the reader converts coordinates, one of `reader.COORDINATE_TYPES`
+    # or None for the reader's default.
+    coordinates = None
+
+    # Rows per INSERT batch. None tunes the size at runtime from the
+    # measured rows/sec, see `batching.BatchSizer`. Can be overridden for
+    # all importers with `sqlageonames --batch-size`.
+    batch_size = None
+
+    # Max bytes held by the rows of a tuned batch
+    max_batch_memory = batching.MAX_BATCH_MEMORY
+
+    # When rows are committed, one of `settings.TRANSACTION_POLICIES`. Can be
+    # overridden for all importers with `sqlageonames --transaction`.
+    transaction_policy = 'importer'
+
+    # Rows per transaction with the `rows` transaction policy
+    commit_every = 100000
+
+    # Whether rows may be filtered with a `reader.RowFilter`, see
+    # `sqlageonames --countries` etc. The tables other tables refer to are
+    # always imported in full.
+    filterable = False
+
 
 class GeonameFeatureImportOptions(ImportOptions):
     file_class = reader.GeonameFeatureReader
@@ -121,17 +513,27 @@ class GeonameCountryImportOptions(ImportOptions):
 class GeonameImportOptions(ImportOptions):
     file_class = reader.GeonameReader
     model = models.Geoname
-    modifiers = [set_geopoint_modifier, clear_empty_fks_modifier]
+    modifiers = [set_geopoints_modifier, clear_empty_fks_batch_modifier]
     model_dependencies = [models.GeonameFeature, models.GeonameTimezone,
                           models.GeonameCountry]
+    write_method = 'binary_copy'
+    parallel = True
+    # The coordinates are only used to make the point
+    coordinates = 'text'
+    filterable = True
 
 
 class GeonamePostalCodeImportOptions(ImportOptions):
     file_class = reader.GeonamePostalCodeReader
     model = models.GeonamePostalCode
-    modifiers = [set_geopoint_modifier, ]
+    modifiers = [set_geopoints_modifier, ]
     model_dependencies = [models.Geoname, models.GeonameFeature,
                           models.GeonameCountry, ]
+    write_method = 'binary_copy'
+    parallel = True
+    # The coordinates are only used to make the point
+    coordinates = 'text'
+    filterable = True
 
 # class GeonameLanguageImportOptions(ImportOptions):
 #     file_class = reader.GeonameIsoLanguageCodesReader
@@ -176,10 +578,16 @@ _import_options_map = {
 }
 
 
-def get_importer_instances(db_session, download_dir, *filepaths):
-    """Creates importer instances from `filepaths` and sorts them by their
-    dependencies.
+def get_importer_instances(db_session, download_dir, *filepaths,
+                           **importer_kwargs):
+    """Creates importer instances from `filepaths` and orders them by their
+    dependencies, see `scheduling`. `importer_kwargs` are passed on to each
+    `Importer`.
+
+    Files that are to be read from a zip archive can be given as
+    `archive_paths`, a dict of filepath to archive path.
     """
+    archive_paths = importer_kwargs.pop('archive_paths', None) or {}
     importer_instances = []
     errmsg = u'No importer defined for filename "{}"'
     for filepath in filepaths:
@@ -189,6 +597,8 @@ def get_importer_instances(db_session, download_dir, *filepaths):
         except KeyError:
             raise Exception(errmsg.format(filename))
         importer_instance = Importer(importer_options, filepath, db_session,
-                                     download_dir)
+                                     download_dir,
+                                     archive_path=archive_paths.get(filepath),
+                                     **importer_kwargs)
         importer_instances.append(importer_instance)
-    return sorted(importer_instances)
+    return scheduling.order_importers(importer_instances)
@@ -0,0 +1,224 @@
+"""Where the time of imports goes
+
+Each importer collects an `ImportStats` with the time spent in each stage:
+
+* `decode` decoding and splitting the file into lines. Only measured on
+  its own for memory-mapped files, otherwise part of `parse`.
+* `parse` splitting lines into cells and converting them, see
+  `reader.compile_row_parser`.
+* `modify` running the modifiers.
+* `write` writing the rows to the database.
+
+Stages are timed per batch of rows, never per row, so collecting them costs
+next to nothing. Time spent in a stage while in another one in the same
+thread, e.g. parsing rows while COPY pulls them, only counts for the inner
+stage. With `pipelined` the writer runs in its own thread and `write`
+includes waiting for rows.
+
+Hooks added with `add_hook` are called with an event name and the stats:
+`batch` after each batch of rows written, with the rows and seconds in
+`ImportStats.last_batch`, and `done` once the importer is done. They can
+be used to export the numbers to a metrics system.
+"""
+from __future__ import absolute_import
+
+import cProfile
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# noinspection PyProtectedMember
+from sqlalchemy_geonames._compat import resource
+
+STAGES = ('decode', 'parse', 'modify', 'write')
+
+# Upper bounds, in milliseconds, of the batch latency histogram's buckets.
+# The last bucket holds the slower batches.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                   10000)
+
+hooks = []
+
+
+def add_hook(hook):
+    """Calls `hook(event, stats)` on the events of all importers"""
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def get_peak_memory():
+    """Peak resident memory of this process in bytes, or None if unknown"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Timing(object):
+    """Seconds spent in a stage, less the time spent in nested stages"""
+    seconds = 0.0
+
+
+class ImportStats(object):
+    """Timings, row counts and batch latencies of an import"""
+
+    def __init__(self, name):
+        # Name of what is being imported, usually the table name
+        self.name = name
+        self.stages = OrderedDict((stage, 0.0) for stage in STAGES)
+        self.rows = 0
+        self.batches = 0
+        # Number of written batches in each of `LATENCY_BUCKETS`
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+        # `(rows, seconds)` of the last batch written
+        self.last_batch = None
+        # Wall clock time of the whole import
+        self.seconds = None
+        self.peak_memory = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # Stats are sent back from the processes of parallel imports
+        state = self.__dict__.copy()
+        del state['_lock'], state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def timer(self, stage):
+        """Adds the time spent in the block to `stage`
+
+        Yields a `Timing` holding the seconds counted once the block is
+        done.
+        """
+        stack = self._local.__dict__.setdefault('stack', [])
+        # Seconds spent in nested stages
+        stack.append(0.0)
+        timing = Timing()
+        started = time.time()
+        try:
+            yield timing
+        finally:
+            elapsed = time.time() - started
+            timing.seconds = elapsed - stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.stages[stage] += timing.seconds
+
+    def record_batch(self, num_rows, seconds):
+        """Records that a batch of `num_rows` was written in `seconds`"""
+        with self._lock:
+            self.rows += num_rows
+            self.batches += 1
+            self.latencies[bisect_left(LATENCY_BUCKETS,
+                                       seconds * 1000)] += 1
+            self.last_batch = (num_rows, seconds)
+        call_hooks('batch', self)
+
+    def merge(self, other):
+        """Adds the numbers of `other`, e.g. of a part of the same file"""
+        with self._lock:
+            for stage, seconds in other.stages.items():
+                self.stages[stage] += seconds
+            self.rows += other.rows
+            self.batches += other.batches
+            self.latencies = [a + b for a, b in zip(self.latencies,
+                                                    other.latencies)]
+            if other.peak_memory is not None:
+                self.peak_memory = max(self.peak_memory or 0,
+                                       other.peak_memory)
+
+    @contextmanager
+    def measure(self):
+        """Measures the wall clock time and peak memory of the import and
+        calls the `done` hooks after
+        """
+        started = time.time()
+        yield
+        self.seconds = time.time() - started
+        peak_memory = get_peak_memory()
+        if peak_memory is not None:
+            self.peak_memory = max(self.peak_memory or 0, peak_memory)
+        call_hooks('done', self)
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return None
+        return self.rows / self.seconds
+
+    def latency_percentile(self, percent):
+        """Upper bound in milliseconds of the bucket holding the `percent`th
+        percentile of the batch latencies, None if slower than all buckets
+        or no batches were written
+        """
+        if not self.batches:
+            return None
+        target = self.batches * percent / 100.0
+        count = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS, self.latencies):
+            count += bucket_count
+            if count >= target:
+                return bound
+        return None
+
+
+def call_hooks(event, stats):
+    for hook in hooks:
+        hook(event, stats)
+
+
+@contextmanager
+def null_timer(stage):
+    """Stands in for `ImportStats.timer` when nothing is measured"""
+    yield Timing()
+
+
+def run_profiled(filepath, func, *args, **kwargs):
+    """Calls `func` under cProfile and writes the profile to `filepath`
+
+    Only the calling thread is profiled. The profile can be read with the
+    `pstats` module or tools like snakeviz.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(filepath)
+
+
+def format_stats(stats_list):
+    """Lines of a table summarizing each of `stats_list`"""
+    header = (u'{:<16} {:>10} {:>9} {:>10}' + u' {:>8}' * len(STAGES) +
+              u' {:>7} {:>7} {:>8}')
+    row = (u'{:<16} {:>10} {:>9.2f} {:>10}' + u' {:>8.2f}' * len(STAGES) +
+           u' {:>7} {:>7} {:>8}')
+    lines = [header.format('Table', 'Rows', 'Seconds', 'Rows/s',
+                           *STAGES + ('p50 ms', 'p95 ms', 'Peak MB'))]
+
+    def optional(value, format_string=u'{}'):
+        return u'-' if value is None else format_string.format(value)
+
+    for stats in stats_list:
+        lines.append(row.format(
+            stats.name, stats.rows, stats.seconds or 0.0,
+            optional(stats.rows_per_second, u'{:.0f}'),
+            *list(stats.stages.values()) + [
+                optional(stats.latency_percentile(50)),
+                optional(stats.latency_percentile(95)),
+                optional(stats.peak_memory and
+                         stats.peak_memory / 1024.0 / 1024, u'{:.0f}')]))
+    return lines
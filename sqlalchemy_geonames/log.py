@@ -10,6 +10,8 @@ def configure_logging(log_level_name='WARNING',
                       handler=logging.StreamHandler):
     log_level = getattr(logging, log_level_name)
     logger = logging.getLogger()
+    # The logger's level filters records before any handler sees them
+    logger.setLevel(log_level)
     log_handler = handler(sys.stdout)
     log_handler.setLevel(log_level)
     logger.addHandler(log_handler)
@@ -3,7 +3,7 @@ from __future__ import absolute_import
 from geoalchemy2 import Geography
 from sqlalchemy import func
 from sqlalchemy import (Column, ForeignKey, Integer, String, Text, BigInteger,
-                        DateTime, Numeric)
+                        DateTime, Numeric, Boolean)
 from sqlalchemy import or_
 from sqlalchemy.orm import relationship
 
@@ -19,6 +19,25 @@ class GeonameMetadata(config.Base):
     last_updated = Column(DateTime(timezone=True), nullable=False)
 
 
+# How far the import of a range of a file got, see `checkpoints`
+class GeonameImportCheckpoint(config.Base):
+    __tablename__ = 'import_checkpoint'
+    __table_args__ = {'schema': config.schema_name, }
+
+    filename = Column(String(255), primary_key=True)
+    # Byte offsets of the range of the file, see `parallel.get_line_ranges`
+    range_start = Column(BigInteger, primary_key=True, autoincrement=False)
+    range_end = Column(BigInteger)
+    # Byte offset and row number to continue reading from
+    offset = Column(BigInteger, nullable=False)
+    rownum = Column(BigInteger, nullable=False)
+    # Rows read from `offset` that are already written
+    skip_rows = Column(Integer, nullable=False, default=0)
+    rows_written = Column(BigInteger, nullable=False, default=0)
+    finished = Column(Boolean, nullable=False, default=False)
+    updated = Column(DateTime(timezone=True), nullable=False)
+
+
 class GeonameCountry(config.Base):
     __tablename__ = 'country'
     __table_args__ = {'schema': config.schema_name, }
@@ -0,0 +1,116 @@
+"""Parallel import of big data dumps
+
+The file is split into newline aligned byte ranges and each range is parsed
+and written to the database by its own process, using its own database
+connection. Worker processes are forked so they inherit the already
+configured models (see `sqla.config`).
+"""
+from __future__ import absolute_import
+
+import io
+import multiprocessing
+import os
+
+from sqlalchemy.orm import sessionmaker
+
+from sqlalchemy_geonames.instrumentation import get_peak_memory
+from sqlalchemy_geonames.sqla import create_db_engine
+
+# Bytes read at a time when looking for line boundaries
+SPLIT_BLOCK_SIZE = 1024 * 1024
+
+
+def get_line_ranges(filepath, parts, block_size=SPLIT_BLOCK_SIZE):
+    """Splits `filepath` into at most `parts` ranges of whole lines
+
+    Returns a list of `(start, end, start_rownum)` tuples, where `start` and
+    `end` are byte offsets (`end` excluded) and `start_rownum` is the row
+    number of the first line in the range. The whole file is scanned once
+    to count the lines before each range, which is cheap compared to
+    parsing it.
+    """
+    size = os.path.getsize(filepath)
+    targets = [size * i // parts for i in range(1, parts)]
+    boundaries = [(0, 0)]
+    offset = 0
+    lines = 0
+    with io.open(filepath, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            while targets:
+                # A very long line may have pushed the last boundary past
+                # the next target.
+                search_from = max(targets[0], boundaries[-1][0]) - offset
+                if search_from >= len(block):
+                    break
+                index = block.find(b'\n', max(search_from, 0))
+                if index == -1:
+                    break
+                boundaries.append(
+                    (offset + index + 1,
+                     lines + block.count(b'\n', 0, index + 1)))
+                targets.pop(0)
+            lines += block.count(b'\n')
+            offset += len(block)
+    ranges = []
+    ends = [start for start, rownum in boundaries[1:]] + [size]
+    for (start, start_rownum), end in zip(boundaries, ends):
+        if end > start:
+            ranges.append((start, end, start_rownum))
+    return ranges
+
+
+def _import_range(args):
+    """Worker process entry point. Imports one range of a file."""
+    from sqlalchemy_geonames.imports import Importer
+
+    (options, filepath, download_dir, db_url, importer_kwargs,
+     range_kwargs) = args
+    engine = create_db_engine(db_url)
+    session = sessionmaker(bind=engine)()
+    try:
+        importer = Importer(options, filepath, session, download_dir,
+                            **importer_kwargs)
+        importer.import_rows(**range_kwargs)
+    finally:
+        session.close()
+        engine.dispose()
+    importer.stats.peak_memory = get_peak_memory()
+    return importer.stats
+
+
+def run_importer_in_parallel(importer, ranges):
+    """Runs `importer` in a process for each of `ranges` of its file, dicts
+    of `Importer.import_rows` arguments, see `Importer.get_ranges`
+
+    The first exception raised by a worker stops the other ones and is
+    re-raised. The stats of the workers are added to the importer's.
+    """
+    importer_kwargs = {'write_method': importer.write_method,
+                       'pipelined': importer.pipelined,
+                       'schema': importer.schema,
+                       'row_filter': importer.row_filter,
+                       'batch_size': importer.batch_size,
+                       'max_batch_memory': importer.max_batch_memory,
+                       'transaction_policy': importer.transaction_policy,
+                       'commit_every': importer.commit_every,
+                       'skip_bad_rows': importer.skip_bad_rows}
+    args = [(importer.options, importer.filepath, importer.download_dir,
+             importer.engine.url, importer_kwargs, range_kwargs)
+            for range_kwargs in ranges]
+    # Forked workers must not share the pooled connections of the parent
+    importer.engine.dispose()
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing
+    pool = context.Pool(min(importer.jobs, len(ranges)))
+    try:
+        for stats in pool.imap_unordered(_import_range, args):
+            importer.stats.merge(stats)
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
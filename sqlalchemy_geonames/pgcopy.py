@@ -0,0 +1,316 @@
+"""Streaming of rows into PostgreSQL with `COPY ... FROM STDIN`
+
+`COPY` skips the per-statement overhead of `executemany` INSERTs. Rows are
+encoded lazily by a file-like object that psycopg2's `copy_expert` reads
+from, so a whole data dump can be loaded without ever being held in memory.
+
+Two encoders are available. `TextCopyEncoder` writes the tab delimited text
+format and works for any column type. `BinaryCopyEncoder` writes the binary
+PGCOPY format, which saves the server from parsing integers, dates and WKT
+points, but only supports the column types used by the geoname models.
+"""
+from __future__ import absolute_import
+
+import re
+from datetime import date, datetime
+from itertools import chain
+from struct import Struct
+
+from geoalchemy2 import Geography, Geometry
+from sqlalchemy import (BigInteger, Boolean, Date, DateTime, Float, Integer,
+                        Numeric, SmallInteger, String)
+
+# noinspection PyProtectedMember
+from sqlalchemy_geonames._compat import text_type, Decimal
+
+# Number of bytes psycopg2 asks for on each `CopyStream.read`. The default
+# of 8192 bytes means a lot of round trips through Python for big dumps.
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class TextCopyEncoder(object):
+    """Encodes rows as PostgreSQL's tab delimited `COPY` text format"""
+
+    copy_options = "FORMAT text, ENCODING 'UTF8'"
+
+    null = u'\\N'
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.column_keys = tuple(c.key for c in columns)
+
+    def header(self):
+        return b''
+
+    def trailer(self):
+        return b''
+
+    def encode_value(self, value):
+        if value is None:
+            return self.null
+        if isinstance(value, text_type):
+            # Backslash must be escaped first as the other escapes add more
+            # of them.
+            return (value.replace(u'\\', u'\\\\')
+                         .replace(u'\t', u'\\t')
+                         .replace(u'\n', u'\\n')
+                         .replace(u'\r', u'\\r'))
+        if isinstance(value, bool):
+            return u't' if value else u'f'
+        if isinstance(value, (date, datetime)):
+            return value.isoformat()
+        return text_type(value)
+
+    def encode_row(self, row):
+        encode_value = self.encode_value
+        line = u'\t'.join([encode_value(row.get(key))
+                           for key in self.column_keys])
+        return (line + u'\n').encode('utf-8')
+
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + Struct('!ii').pack(0, 0)
+PGCOPY_TRAILER = Struct('!h').pack(-1)
+PG_EPOCH_DATE = date(2000, 1, 1)
+PG_EPOCH_DATETIME = datetime(2000, 1, 1)
+
+# Every binary field is prefixed by its length in bytes. Fixed size values
+# are packed together with their length prefix.
+_length = Struct('!i').pack
+_null = _length(-1)
+_int2 = Struct('!ih').pack
+_int4 = Struct('!ii').pack
+_int8 = Struct('!iq').pack
+_float8 = Struct('!id').pack
+_numeric_header = Struct('!ihhhh').pack
+_numeric_digit = Struct('!h').pack
+
+# EWKB point: little endian byte order marker, geometry type with the SRID
+# flag set, SRID and the two coordinates.
+_ewkb_point = Struct('<BIIdd').pack
+_ewkb_point_length = _length(25)
+EWKB_POINT_WITH_SRID = 0x20000001
+DEFAULT_SRID = 4326
+
+_wkt_point_re = re.compile(r'^\s*POINT\s*\(\s*(\S+)\s+(\S+)\s*\)\s*$',
+                           re.IGNORECASE)
+
+NUMERIC_POS = 0x0000
+NUMERIC_NEG = 0x4000
+
+
+def encode_smallint(value):
+    return _int2(2, int(value))
+
+
+def encode_int(value):
+    return _int4(4, int(value))
+
+
+def encode_bigint(value):
+    return _int8(8, int(value))
+
+
+def encode_float(value):
+    return _float8(8, float(value))
+
+
+def encode_text(value):
+    if not isinstance(value, text_type):
+        value = text_type(value)
+    value = value.encode('utf-8')
+    return _length(len(value)) + value
+
+
+def encode_bool(value):
+    return _length(1) + (b'\x01' if value else b'\x00')
+
+
+def encode_date(value):
+    return _int4(4, (value - PG_EPOCH_DATE).days)
+
+
+def encode_timestamp(value):
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    delta = value - PG_EPOCH_DATETIME
+    microseconds = (delta.days * 86400 + delta.seconds) * 10 ** 6 + \
+        delta.microseconds
+    return _int8(8, microseconds)
+
+
+def encode_numeric(value):
+    """Encodes `value` as PostgreSQL's binary NUMERIC
+
+    NUMERIC is sent as base 10000 digits, the weight (exponent) of the
+    first digit, the sign and the display scale.
+    """
+    sign, digits, exponent = Decimal(value).as_tuple()
+    if not isinstance(exponent, int):
+        raise ValueError(u'Can not encode {} as NUMERIC'.format(value))
+    dscale = max(0, -exponent)
+    # Align the digits on a base 10000 boundary on both sides of the
+    # decimal point.
+    padding = exponent % 4
+    digits = tuple(digits) + (0,) * padding
+    exponent -= padding
+    digits = (0,) * (-len(digits) % 4) + digits
+    groups = [digits[i] * 1000 + digits[i + 1] * 100 + digits[i + 2] * 10 +
+              digits[i + 3] for i in range(0, len(digits), 4)]
+    weight = len(groups) - 1 + exponent // 4
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+    return (_numeric_header(8 + 2 * len(groups), len(groups), weight,
+                            NUMERIC_NEG if sign else NUMERIC_POS, dscale) +
+            b''.join(_numeric_digit(g) for g in groups))
+
+
+def get_point_encoder(srid):
+    def encode_point(value):
+        """Encodes `value` as an EWKB point
+
+        `value` is either a `(x, y)` sequence or a WKT point string, as set
+        by `imports.set_geopoint_modifier`.
+        """
+        if isinstance(value, text_type):
+            match = _wkt_point_re.match(value)
+            if match is None:
+                raise ValueError(u'"{}" is not a WKT point'.format(value))
+            value = match.groups()
+        x, y = value
+        return _ewkb_point_length + _ewkb_point(
+            1, EWKB_POINT_WITH_SRID, srid, float(x), float(y))
+    return encode_point
+
+
+def get_binary_value_encoder(column):
+    """Returns a function encoding values of `column` as a PGCOPY field"""
+    type_ = column.type
+    # Subclasses must be checked before their base classes
+    if isinstance(type_, (Geography, Geometry)):
+        srid = type_.srid if type_.srid and type_.srid > 0 else DEFAULT_SRID
+        return get_point_encoder(srid)
+    if isinstance(type_, SmallInteger):
+        return encode_smallint
+    if isinstance(type_, BigInteger):
+        return encode_bigint
+    if isinstance(type_, Integer):
+        return encode_int
+    if isinstance(type_, Float):
+        return encode_float
+    if isinstance(type_, Numeric):
+        return encode_numeric
+    if isinstance(type_, String):
+        return encode_text
+    if isinstance(type_, Boolean):
+        return encode_bool
+    if isinstance(type_, DateTime):
+        return encode_timestamp
+    if isinstance(type_, Date):
+        return encode_date
+    raise TypeError(u'Column "{}" of type {} can not be encoded for binary '
+                    u'COPY'.format(column.name, type_))
+
+
+class BinaryCopyEncoder(object):
+    """Encodes rows as PostgreSQL's binary `COPY` format (PGCOPY)
+
+    Values are converted with the column's Python type first, so e.g. an
+    Integer column may be given strings of digits. Geography and Geometry
+    columns are written as EWKB points.
+    """
+
+    copy_options = 'FORMAT binary'
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.column_keys = tuple(c.key for c in columns)
+        self.value_encoders = tuple((c.key, get_binary_value_encoder(c))
+                                    for c in columns)
+        self.row_header = Struct('!h').pack(len(columns))
+
+    def header(self):
+        return PGCOPY_HEADER
+
+    def trailer(self):
+        return PGCOPY_TRAILER
+
+    def encode_row(self, row):
+        fields = [self.row_header]
+        append = fields.append
+        for key, encode in self.value_encoders:
+            value = row.get(key)
+            append(_null if value is None else encode(value))
+        return b''.join(fields)
+
+
+class CopyStream(object):
+    """Read-only file-like object of encoded `rows`, consumed by `COPY`"""
+
+    def __init__(self, rows, encoder):
+        self.rows = iter(rows)
+        self.encoder = encoder
+        self.row_count = 0
+        self._buffer = encoder.header()
+        self._exhausted = False
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        encode_row = self.encoder.encode_row
+        while not self._exhausted and (size < 0 or length < size):
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                self._exhausted = True
+                chunk = self.encoder.trailer()
+            else:
+                self.row_count += 1
+                chunk = encode_row(row)
+            chunks.append(chunk)
+            length += len(chunk)
+        data = b''.join(chunks)
+        if size < 0 or length <= size:
+            self._buffer = b''
+            return data
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def get_copy_statement(dialect, table, columns, copy_options):
+    preparer = dialect.identifier_preparer
+    return u'COPY {} ({}) FROM STDIN WITH ({})'.format(
+        preparer.format_table(table),
+        u', '.join(preparer.quote(c.name) for c in columns),
+        copy_options,
+    )
+
+
+def copy_rows(connection, table, rows, encoder_class=TextCopyEncoder,
+              buffer_size=COPY_BUFFER_SIZE):
+    """Streams `rows` (dicts) into `table` over SQLAlchemy `connection`
+
+    The columns to load are the ones of `table` that are present in the
+    first row. Missing values in later rows are loaded as NULL. Returns the
+    number of rows copied. Transaction handling is left to the caller.
+    """
+    rows = iter(rows)
+    try:
+        first_row = next(rows)
+    except StopIteration:
+        return 0
+    columns = [c for c in table.columns if c.key in first_row]
+    encoder = encoder_class(columns)
+    stream = CopyStream(chain([first_row], rows), encoder)
+    statement = get_copy_statement(connection.dialect, table, columns,
+                                   encoder.copy_options)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(statement, stream, size=buffer_size)
+    finally:
+        cursor.close()
+    return stream.row_count
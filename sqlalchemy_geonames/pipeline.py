@@ -0,0 +1,87 @@
+"""Overlapping of parsing and database writes
+
+Rows are produced (read and modified) in the calling thread and handed in
+batches to a writer thread through a bounded queue. The producer blocks
+when the queue is full, so no more than `max_batches` batches are waiting
+to be written at any time.
+"""
+from __future__ import absolute_import
+
+import sys
+import threading
+
+# noinspection PyProtectedMember
+from sqlalchemy_geonames._compat import queue, reraise
+
+# How long the producer waits on a full queue before checking whether the
+# writer has stopped.
+PUT_TIMEOUT = 0.1
+
+_done = object()
+_abort = object()
+
+
+class PipelineAborted(Exception):
+    """Raised in the writer thread when the producer failed"""
+
+
+def run_pipelined(rows, write_rows, batch_size=500, max_batches=4):
+    """Iterates `rows` while `write_rows` writes them in another thread
+
+    `write_rows` is called once with an iterable of all rows. An exception
+    in either the producer or the writer stops both and is re-raised here.
+    If the producer fails the writer's iterable raises `PipelineAborted`,
+    so it can roll back what it has not committed.
+    """
+    batches = queue.Queue(maxsize=max_batches)
+    writer_errors = []
+
+    def iter_batches():
+        while True:
+            batch = batches.get()
+            if batch is _done:
+                return
+            if batch is _abort:
+                raise PipelineAborted()
+            for row in batch:
+                yield row
+
+    def writer():
+        try:
+            write_rows(iter_batches())
+        except BaseException:
+            writer_errors.append(sys.exc_info())
+
+    thread = threading.Thread(target=writer, name='geonames-writer')
+    thread.daemon = True
+    thread.start()
+
+    def put(item):
+        """Puts `item` on the queue unless the writer has stopped"""
+        while thread.is_alive():
+            try:
+                batches.put(item, timeout=PUT_TIMEOUT)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    try:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                if not put(batch):
+                    break
+                batch = []
+        else:
+            if batch:
+                put(batch)
+            put(_done)
+    except BaseException:
+        put(_abort)
+        thread.join()
+        raise
+    thread.join()
+    if writer_errors:
+        reraise(*writer_errors[0])
@@ -1,16 +1,31 @@
 """Classes for reading geonames text data dumps"""
 from __future__ import absolute_import
 
-import codecs
+import io
+import mmap
+import os
+from contextlib import contextmanager
 from datetime import date
+from zipfile import ZipFile
 
-from sqlalchemy_geonames import log
+from sqlalchemy_geonames import log, instrumentation
 # noinspection PyProtectedMember
-from sqlalchemy_geonames._compat import text_type, Decimal
+from sqlalchemy_geonames._compat import text_type, Decimal, numpy
 from sqlalchemy_geonames.utils import cached_property, try_int
 
 logger = log.get_logger()
 
+# Read buffer used when decompressing zip archive members
+ZIP_BUFFER_SIZE = 1024 * 1024
+
+# Bytes of a memory-mapped file decoded and split into lines at a time
+MMAP_BLOCK_SIZE = 1024 * 1024
+
+# `lines` reads and decodes the file a line at a time. `mmap` memory-maps
+# it and decodes blocks of many lines at once, which saves a read and a
+# decode call per line.
+READER_ENGINES = ('lines', 'mmap')
+
 
 def fastdate(val):
     """Fast parsing of date object from string values
@@ -22,6 +37,245 @@ def fastdate(val):
     return date(int(val[:4]), int(val[5:7]), int(val[8:10]))
 
 
+# Converters of coordinate fields by coordinate mode. Coordinates that only
+# end up in a point (see `imports.set_geopoints_modifier`) need not be parsed
+# as Decimals. `text` keeps them as they are in the file.
+COORDINATE_TYPES = {
+    'decimal': Decimal,
+    'float': float,
+    'text': text_type,
+}
+
+
+# Compiled row parsers by field definitions, see `compile_row_parser`
+_row_parsers = {}
+
+
+def compile_row_parser(field_definitions, fields=None, record_class=None,
+                       dictionaries=None, encode=False):
+    """Builds a function converting a list of cell values to a row dict
+
+    The function is generated from `field_definitions` with each converter
+    inlined, which saves a loop, a try/except and a dict store per cell
+    compared to interpreting the definitions for every row. Text cells are
+    already decoded, so `text_type` converters are left out altogether.
+    If `fields` is given only those fields are converted and returned.
+    Rows are instances of `record_class` instead of dicts if given, see
+    `get_record_class`.
+
+    `dictionaries` maps names of text fields to a dict to intern their
+    values in. Equal values then share one object. With `encode` the values
+    are replaced by integer codes instead, in order of appearance.
+    """
+    dictionaries = dictionaries or {}
+    parser_key = (field_definitions, fields, record_class,
+                  tuple(sorted(dictionaries)), encode)
+    try:
+        make_parser = _row_parsers[parser_key]
+    except KeyError:
+        make_parser = _row_parsers[parser_key] = _compile_parser_factory(
+            field_definitions, fields, record_class, dictionaries, encode)
+    return make_parser(*[dictionaries[key] for key, type_def
+                         in field_definitions if key in dictionaries])
+
+
+def _compile_parser_factory(field_definitions, fields, record_class,
+                            dictionaries, encode):
+    """Generates a function taking the `dictionaries` and returning a row
+    parser, see `compile_row_parser`.
+    """
+    namespace = {}
+    items = []
+    for i, (key, type_def) in enumerate(field_definitions):
+        if fields is not None and key not in fields:
+            continue
+        value = u'cells[{}]'.format(i)
+        if key in dictionaries:
+            dictionary_name = u'values_{}'.format(i)
+            if type_def is not text_type:
+                raise ValueError(u'Only text fields can be interned, not '
+                                 u'{}'.format(key))
+            # dict.setdefault looks up the value and adds it if missing in
+            # one C call.
+            value = u'{0}.setdefault({1}, {2})'.format(
+                dictionary_name, value,
+                u'len({})'.format(dictionary_name) if encode else value)
+        elif type_def is not text_type:
+            converter_name = u'convert_{}'.format(i)
+            namespace[converter_name] = type_def
+            value = u'{}({})'.format(converter_name, value)
+        items.append((key, value))
+    if record_class is None:
+        row = u'{{{}}}'.format(u', '.join(
+            u'{!r}: {}'.format(key, value) for key, value in items))
+    else:
+        namespace['Record'] = record_class
+        row = u'Record({})'.format(u', '.join(value for key, value in items))
+    source = (u'def make_parser({}):\n'
+              u'    def parse_row(cells):\n'
+              u'        return {}\n'
+              u'    return parse_row\n').format(
+        u', '.join(u'values_{}'.format(i)
+                   for i, (key, type_def) in enumerate(field_definitions)
+                   if key in dictionaries), row)
+    exec(compile(source, '<row parser>', 'exec'), namespace)
+    return namespace['make_parser']
+
+
+class Record(object):
+    """Base class of compact rows, see `get_record_class`
+
+    The fields are stored in slots instead of a dict, which takes a
+    fraction of the memory. Records support the parts of the mapping
+    interface that SQLAlchemy's executemany and the COPY encoders use, and
+    existing fields can be set with `record[key] = value`.
+    """
+    __slots__ = ()
+    _field_set = frozenset()
+
+    def __getitem__(self, key):
+        if key not in self._field_set:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self._field_set:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self._field_set
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other._asdict()
+        return self._asdict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join(
+            '{}={!r}'.format(key, getattr(self, key))
+            for key in self.__slots__))
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def get(self, key, default=None):
+        if key not in self._field_set:
+            return default
+        return getattr(self, key)
+
+    def _asdict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+
+# Record classes by name and field names, see `get_record_class`
+_record_classes = {}
+
+
+def get_record_class(name, field_names):
+    """Returns a `Record` subclass with a slot for each of `field_names`
+
+    Its constructor takes the values of the fields in order.
+    """
+    class_key = (name, tuple(field_names))
+    try:
+        return _record_classes[class_key]
+    except KeyError:
+        pass
+    source = u'def __init__(self, {0}):\n{1}\n'.format(
+        u', '.join(field_names),
+        u'\n'.join(u'    self.{0} = {0}'.format(key) for key in field_names))
+    namespace = {}
+    exec(compile(source, '<record>', 'exec'), namespace)
+    record_class = _record_classes[class_key] = type(str(name), (Record,), {
+        '__slots__': tuple(str(key) for key in field_names),
+        '_field_set': frozenset(field_names),
+        '__init__': namespace['__init__'],
+    })
+    return record_class
+
+
+class RowFilter(object):
+    """Conditions a row must meet to be read
+
+    The conditions are checked on the split but unconverted cells, so
+    rejected rows cost little more than splitting them. Conditions on fields
+    a file doesn't have are left out, which allows using one filter for
+    both the geoname and the postal code files.
+
+    `bbox` is `(min_latitude, min_longitude, max_latitude, max_longitude)`.
+    A `min_longitude` greater than `max_longitude` crosses the 180th
+    meridian.
+    """
+
+    def __init__(self, country_codes=None, feature_classes=None,
+                 feature_codes=None, min_population=None, bbox=None):
+        self.country_codes = _optional_set(country_codes)
+        self.feature_classes = _optional_set(feature_classes)
+        self.feature_codes = _optional_set(feature_codes)
+        self.min_population = min_population
+        self.bbox = tuple(float(v) for v in bbox) if bbox else None
+
+    def __repr__(self):
+        return '<RowFilter: {}>'.format(', '.join(
+            '{}={!r}'.format(key, value)
+            for key, value in sorted(vars(self).items())
+            if value is not None))
+
+    def __bool__(self):
+        return any(value is not None for value in vars(self).values())
+    __nonzero__ = __bool__
+
+    def compile(self, field_names):
+        """Builds a function of a list of cell values, returning whether to
+        keep the row. `field_names` are the names of the cells.
+        """
+        index = dict((key, i) for i, key in enumerate(field_names))
+        namespace = dict(vars(self))
+        conditions = []
+        for key, values in (('country_code', 'country_codes'),
+                            ('feature_class', 'feature_classes'),
+                            ('feature_code', 'feature_codes')):
+            if getattr(self, values) is not None and key in index:
+                conditions.append(u'cells[{}] in {}'.format(index[key],
+                                                            values))
+        if self.min_population is not None and 'population' in index:
+            conditions.append(u'int(cells[{}] or 0) >= min_population'.format(
+                index['population']))
+        if self.bbox is not None and 'latitude' in index:
+            min_lat, min_lon, max_lat, max_lon = self.bbox
+            namespace.update(min_lat=min_lat, min_lon=min_lon,
+                             max_lat=max_lat, max_lon=max_lon)
+            conditions.append(u'min_lat <= float(cells[{}]) <= max_lat'.format(
+                index['latitude']))
+            longitude = u'float(cells[{}])'.format(index['longitude'])
+            if min_lon <= max_lon:
+                conditions.append(u'min_lon <= {} <= max_lon'.format(
+                    longitude))
+            else:
+                conditions.append(u'({0} >= min_lon or {0} <= max_lon)'.format(
+                    longitude))
+        source = u'def accept_row(cells):\n    return {}\n'.format(
+            u' and '.join(conditions) or u'True')
+        exec(compile(source, '<row filter>', 'exec'), namespace)
+        return namespace['accept_row']
+
+
+def _optional_set(values):
+    return frozenset(values) if values is not None else None
+
+
 class BaseGeonameReader(object):
 
     # The first row with data (0-indexed). Some files, like timeZones.txt
@@ -64,62 +318,352 @@ class BaseGeonameReader(object):
     #     )
     field_definitions = None
 
+    # Fields converted according to the `coordinates` mode, see
+    # `COORDINATE_TYPES`.
+    coordinate_fields = ()
+
+    # Text fields with few distinct values. Their values are interned, so
+    # rows share one object per distinct value instead of each holding its
+    # own copy.
+    interned_fields = ()
+
+    # NumPy dtypes of numeric fields, used by `iter_columns`. Missing values
+    # in float columns become NaN, so nullable integers should be floats.
+    column_dtypes = {}
+
     @cached_property
     def field_names(self):
-        return tuple(fd[0] for fd in self.field_definitions)
+        """Names of the fields in each row, in file order"""
+        return tuple(fd[0] for fd in self.field_definitions
+                     if self.fields is None or fd[0] in self.fields)
 
     @cached_property
     def type_definitions(self):
         return tuple(fd[1] for fd in self.field_definitions)
 
-    def __init__(self, filepath):
+    @cached_property
+    def record_class(self):
+        """Class of the rows if reading `records`"""
+        name = self.__class__.__name__.replace('Reader', '') + 'Record'
+        return get_record_class(name, self.field_names)
+
+    @cached_property
+    def row_parser(self):
+        return compile_row_parser(
+            self.field_definitions, self.fields,
+            self.record_class if self.records else None,
+            self.dictionaries, self.dictionary_encode)
+
+    def get_dictionary(self, key):
+        """Values of the interned field `key` in order of their codes, as
+        given when `dictionary_encode` is enabled
+        """
+        values = self.dictionaries[key]
+        decoded = [None] * len(values)
+        for value, code in values.items():
+            decoded[code] = value
+        return decoded
+
+    def convert_cells(self, cell_values):
+        """Converts cell values to a row dict one cell at a time, logging
+        the cell that couldn't be converted. Same result as `row_parser`.
+        """
+        # NOTE 2: Using OrderedDict is about 280% slower so avoid at
+        #         all costs. 280% is a lot when working with ~8.5M
+        #         rows!
+        dct = dict()
+        fields = self.fields
+        for i, (key, type_def) in enumerate(self.field_definitions):
+            if fields is not None and key not in fields:
+                continue
+            try:
+                dct[key] = type_def(cell_values[i])
+            except Exception as exc:
+                logger.error(u'Got {0} for key "{1}" with value '
+                             u'"{2}".'.format(exc.__class__.__name__,
+                                              key, cell_values[i]))
+                raise
+        return dct
+
+    # One of `READER_ENGINES`. Sources that can't be memory-mapped, like
+    # streams and zip archive members, are always read as lines.
+    engine = 'mmap'
+
+    def __init__(self, filepath, start=0, end=None, start_rownum=0,
+                 member=None, coordinates=None, engine=None, fields=None,
+                 row_filter=None, records=False, interned_fields=None,
+                 dictionary_encode=False, stats=None):
+        # `filepath` is either a path or a binary file object. If `member`
+        # is given `filepath` is a zip archive and `member` the name of the
+        # file in it to read, which is decompressed on the fly.
         self.filepath = filepath
+        self.member = member
+        # Byte range of the file to read, `end` excluded. `start` must be at
+        # the beginning of a line and `start_rownum` the row number of that
+        # line, so messages refer to rows in the whole file. Used when
+        # importing chunks of a file in parallel.
+        self.start = start
+        self.end = end
+        self.start_rownum = start_rownum
+        if coordinates is not None:
+            self.set_coordinate_type(COORDINATE_TYPES[coordinates])
+        if engine is not None:
+            if engine not in READER_ENGINES:
+                raise ValueError(u'Unknown reader engine "{}"'.format(engine))
+            self.engine = engine
+        # Names of the fields to convert and return. Other cells are skipped
+        # and never stored in the rows.
+        if fields is not None:
+            fields = frozenset(fields)
+            unknown = fields.difference(fd[0] for fd in self.field_definitions)
+            if unknown:
+                raise ValueError(u'Unknown fields: {}'.format(
+                    u', '.join(sorted(unknown))))
+        self.fields = fields
+        # A `RowFilter`, rows not meeting its conditions are skipped
+        self.row_filter = row_filter
+        # Yield compact `Record`s instead of dicts
+        self.records = records
+        # Interned values of each of `interned_fields`. With
+        # `dictionary_encode` the values map to integer codes, which rows
+        # hold instead of the values.
+        if interned_fields is not None:
+            self.interned_fields = tuple(interned_fields)
+        unknown = set(self.interned_fields).difference(
+            fd[0] for fd in self.field_definitions)
+        if unknown:
+            raise ValueError(u'Unknown fields: {}'.format(
+                u', '.join(sorted(unknown))))
+        self.dictionaries = dict((key, {}) for key in self.interned_fields)
+        self.dictionary_encode = dictionary_encode
+        # Row number of the last line read, see `get_position`
+        self._rownum = None
+        # An `instrumentation.ImportStats` to add the time spent decoding to
+        self.stats = stats
+
+    def set_coordinate_type(self, type_def):
+        """Converts `coordinate_fields` with `type_def` instead"""
+        self.field_definitions = tuple(
+            (key, type_def if key in self.coordinate_fields else value_type)
+            for key, value_type in self.field_definitions)
 
-    def __iter__(self):
+    @cached_property
+    def name(self):
+        """Name of the source used in messages"""
+        if self.member is not None:
+            return u'{}:{}'.format(self.filepath, self.member)
+        return getattr(self.filepath, 'name', self.filepath)
+
+    @contextmanager
+    def open(self):
+        """Opens the source for reading bytes"""
+        if self.member is not None:
+            with ZipFile(self.filepath) as zip_file:
+                with zip_file.open(self.member) as fh:
+                    # ZipExtFile.readline is slow, buffer it in C instead
+                    yield io.BufferedReader(fh, ZIP_BUFFER_SIZE)
+        elif hasattr(self.filepath, 'read'):
+            # Streams are owned by the caller and left open
+            yield self.filepath
+        else:
+            with io.open(self.filepath, 'rb') as fh:
+                yield fh
+
+    @cached_property
+    def use_mmap(self):
+        return (self.engine == 'mmap' and self.member is None and
+                not hasattr(self.filepath, 'read'))
+
+    def iter_lines(self):
+        """Yields row numbers and decoded lines of the range being read"""
+        if self.use_mmap:
+            return self.iter_mmap_lines()
+        return self.iter_file_lines()
+
+    def iter_mmap_lines(self):
+        """Yields row numbers and decoded lines, without line endings, of
+        the range being read from the memory-mapped file
+        """
+        with io.open(self.filepath, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            end = size if self.end is None else min(self.end, size)
+            if self.start >= end:
+                # Empty files can't be mapped
+                return
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            timer = (instrumentation.null_timer if self.stats is None
+                     else self.stats.timer)
+            try:
+                rownum = self.start_rownum
+                block_start = self.start
+                while block_start < end:
+                    # Blocks end after a line ending, which never is part
+                    # of a multi-byte character.
+                    block_end = min(block_start + MMAP_BLOCK_SIZE, end)
+                    if block_end < end:
+                        newline = data.rfind(b'\n', block_start, block_end)
+                        if newline == -1:
+                            newline = data.find(b'\n', block_end, end)
+                        block_end = end if newline == -1 else newline + 1
+                    with timer('decode'):
+                        lines = data[block_start:block_end].decode(
+                            'utf-8').split(u'\n')
+                    if not lines[-1]:
+                        # The block ended with a line ending
+                        lines.pop()
+                    self._block = (block_start, block_end, rownum, lines)
+                    for line in lines:
+                        self._rownum = rownum
+                        yield rownum, line
+                        rownum += 1
+                    block_start = block_end
+            finally:
+                data.close()
+
+    def iter_file_lines(self):
+        """Yields row numbers and decoded lines read one at a time"""
+        with self.open() as fh:
+            if self.start:
+                fh.seek(self.start)
+            position = self.start
+            end = self.end
+            for rownum, line in enumerate(fh, self.start_rownum):
+                if end is not None and position >= end:
+                    break
+                position += len(line)
+                self._rownum = rownum
+                self._position = position
+                yield rownum, line.decode('utf-8')
+
+    def get_position(self):
+        """Byte offset and row number of the line after the last one read
+
+        Reading can be continued from there by passing them as `start` and
+        `start_rownum` to a new reader. Lines are read one at a time as rows
+        are iterated, so after a row is yielded this is where the next row
+        would be read from.
+        """
+        if self._rownum is None:
+            return self.start, self.start_rownum
+        if not self.use_mmap:
+            return self._position, self._rownum + 1
+        # Only the lines of the current block are kept decoded, so count the
+        # bytes up to the last one read.
+        block_start, block_end, block_rownum, lines = self._block
+        read = lines[:self._rownum - block_rownum + 1]
+        offset = block_start + len(u'\n'.join(read).encode('utf-8')) + 1
+        return min(offset, block_end), self._rownum + 1
+
+    def iter_cells(self):
+        """Yields row numbers and lists of (unconverted) cell values"""
         diffmsg = (u"Row #{0} in {1} contained {2} cell values instead"
                    u" of the expected {3}.")
         skipmsg = u"Row #{0} in {1} skipped as some values were missing"
         len_type_definitions = len(self.type_definitions)
-
-        with codecs.open(self.filepath, encoding='utf-8') as fh:
-            for rownum, row in enumerate(fh):
-                if rownum < self.start_row:
+        accept_row = None
+        if self.row_filter:
+            accept_row = self.row_filter.compile(
+                [fd[0] for fd in self.field_definitions])
+
+        for rownum, row in self.iter_lines():
+            if rownum < self.start_row:
+                continue
+            if row.startswith(self.comment_character):
+                continue
+            row = self.row_preprocess(row)
+            cell_values = row.rstrip('\n').split(self.delimiter)
+
+            # Warn on missing values. An index error will be raised later
+            # on too many cell values. The same goes for too few cell
+            # values, unless `append_on_missing` is enabled.
+            cell_count_diff = len_type_definitions - len(cell_values)
+            if cell_count_diff != 0:
+                logger.warning(diffmsg.format(rownum, self.name,
+                               len(cell_values),
+                               len_type_definitions))
+                if self.skip_on_missing and cell_count_diff > 0:
+                    logger.warning(skipmsg.format(rownum, self.name))
                     continue
-                if row.startswith(self.comment_character):
-                    continue
-                row = self.row_preprocess(row)
-                cell_values = row.rstrip('\n').split(self.delimiter)
-
-                # Warn on missing values. An index error will be raised later
-                # on too many cell values. The same goes for too few cell
-                # values, unless `append_on_missing` is enabled.
-                cell_count_diff = len_type_definitions - len(cell_values)
-                if cell_count_diff != 0:
-                    logger.warning(diffmsg.format(rownum, self.filepath,
-                                   len(cell_values),
-                                   len_type_definitions))
-                    if self.skip_on_missing and cell_count_diff > 0:
-                        logger.warning(skipmsg.format(rownum, self.filepath))
-                        continue
-                    if self.append_on_missing and cell_count_diff > 0:
-                        cell_values += [''] * cell_count_diff
-
-                # NOTE 2: Using OrderedDict is about 280% slower so avoid at
-                #         all costs. 280% is a lot when working with ~8.5M
-                #         rows!
-                dct = dict()
-                for i, (key, type_def) in enumerate(self.field_definitions):
-                    try:
-                        dct[key] = type_def(cell_values[i])
-                    except Exception as exc:
-                        logger.error(u'Got {0} for key "{1}" with value '
-                                     u'"{2}".'.format(exc.__class__.__name__,
-                                                      key, cell_values[i]))
-                        raise
-                yield dct
+                if self.append_on_missing and cell_count_diff > 0:
+                    cell_values += [''] * cell_count_diff
+            if accept_row is not None and not accept_row(cell_values):
+                continue
+            yield rownum, cell_values
+
+    def __iter__(self):
+        row_parser = self.row_parser
+        for rownum, cell_values in self.iter_cells():
+            try:
+                dct = row_parser(cell_values)
+            except Exception:
+                # Convert again cell by cell to log which one failed
+                self.convert_cells(cell_values)
+                raise
+            yield dct
+
+    def iter_columns(self, batch_size=10000):
+        """Yields batches of up to `batch_size` rows as dicts of columns
+
+        Each column is a list of converted values, or a NumPy array for the
+        fields in `column_dtypes` if NumPy is installed. A batch can be
+        passed straight to `pandas.DataFrame`. Compared to iterating rows
+        this saves building a dict per row.
+        """
+        batch = []
+        for rownum, cell_values in self.iter_cells():
+            batch.append(cell_values)
+            if len(batch) >= batch_size:
+                yield self.build_columns(batch)
+                batch = []
+        if batch:
+            yield self.build_columns(batch)
+
+    def build_columns(self, batch):
+        """Converts a list of cell value lists to a dict of columns"""
+        columns = {}
+        fields = self.fields
+        for i, (key, type_def) in enumerate(self.field_definitions):
+            if fields is not None and key not in fields:
+                continue
+            values = [cell_values[i] for cell_values in batch]
+            dtype = self.column_dtypes.get(key) if numpy else None
+            try:
+                if dtype is not None:
+                    if numpy.dtype(dtype).kind == 'f':
+                        # Missing values become NaN
+                        values = [v or 'nan' for v in values]
+                    columns[key] = numpy.array(values, dtype=dtype)
+                elif key in self.dictionaries:
+                    columns[key] = self.encode_column(key, values)
+                elif type_def is text_type:
+                    columns[key] = values
+                else:
+                    columns[key] = [type_def(v) for v in values]
+            except Exception:
+                # Convert the batch row by row to log which cell failed
+                for cell_values in batch:
+                    self.convert_cells(cell_values)
+                raise
+        return columns
+
+    def encode_column(self, key, values):
+        """Interns the values of a column of the interned field `key`, or
+        replaces them with their codes if `dictionary_encode` is enabled
+        """
+        dictionary = self.dictionaries[key]
+        setdefault = dictionary.setdefault
+        if not self.dictionary_encode:
+            return [setdefault(v, v) for v in values]
+        codes = [setdefault(v, len(dictionary)) for v in values]
+        return numpy.array(codes, dtype='int32') if numpy else codes
 
 
 class GeonameReader(BaseGeonameReader):
+    coordinate_fields = ('latitude', 'longitude')
+
+    interned_fields = ('feature_class', 'feature_code', 'country_code',
+                       'cc2', 'admin1_code', 'timezone_id', 'dem')
+
     field_definitions = (
         ('geonameid', int),
         ('name', text_type),
@@ -142,6 +686,23 @@ class GeonameReader(BaseGeonameReader):
         ('modification_date', fastdate),
     )
 
+    column_dtypes = {
+        'geonameid': 'int32',
+        'latitude': 'float64',
+        'longitude': 'float64',
+        'population': 'int64',
+        'elevation': 'float64',
+    }
+
+
+class GeonameDeletesReader(BaseGeonameReader):
+    # deletes-YYYY-MM-DD.txt, geonames deleted on the given day
+    field_definitions = (
+        ('geonameid', int),
+        ('name', text_type),
+        ('comment', text_type),
+    )
+
 
 class GeonameFeatureReader(BaseGeonameReader):
     skip_on_missing = True
@@ -206,6 +767,11 @@ class GeonameAlternateNamesReader(BaseGeonameReader):
 
 
 class GeonamePostalCodeReader(BaseGeonameReader):
+    coordinate_fields = ('latitude', 'longitude')
+
+    interned_fields = ('country_code', 'admin_name1', 'admin_code1',
+                       'admin_name2', 'admin_code2')
+
     field_definitions = (
         ('country_code', text_type),
         ('postal_code', text_type),
@@ -220,3 +786,9 @@ class GeonamePostalCodeReader(BaseGeonameReader):
         ('longitude', Decimal),
         ('accuracy', try_int),
     )
+
+    column_dtypes = {
+        'latitude': 'float64',
+        'longitude': 'float64',
+        'accuracy': 'float64',
+    }
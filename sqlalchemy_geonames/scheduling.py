@@ -0,0 +1,121 @@
+"""Running importers in the order of their dependencies
+
+An importer depends on the importers of the models in its options'
+`model_dependencies`, as their tables are referred to by foreign keys.
+Importers run in worker threads, each over its own connection, and each one
+is started as soon as the importers it depends on are done. The feature,
+timezone and country tables are thereby loaded at the same time, as are the
+geoname and postal code tables when there are enough workers.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+import threading
+import time
+
+# noinspection PyProtectedMember
+from sqlalchemy_geonames._compat import queue, reraise
+
+
+def get_dependencies(importers):
+    """Maps each of `importers` to the ones among them it depends on"""
+    return {importer: [other for other in importers
+                       if other is not importer and
+                       other.model in importer.model_dependencies]
+            for importer in importers}
+
+
+def order_importers(importers):
+    """`importers` in an order they can run one after another in
+
+    Importers that don't depend on each other keep their order.
+    """
+    dependencies = get_dependencies(importers)
+    ordered = []
+    remaining = list(importers)
+    while remaining:
+        ready = [importer for importer in remaining
+                 if all(dependency in ordered
+                        for dependency in dependencies[importer])]
+        if not ready:
+            raise Exception(u'Circular dependencies between {}'.format(
+                u', '.join(str(importer) for importer in remaining)))
+        ordered.extend(ready)
+        remaining = [importer for importer in remaining
+                     if importer not in ready]
+    return ordered
+
+
+def run_importers(importers, workers=1):
+    """Runs `importers` in `workers` threads, each once its dependencies are
+    done
+
+    The first exception raised by an importer stops any more from being
+    started and is re-raised once the running ones are done. Returns a list
+    of `(importer, seconds)` in the order the importers finished.
+
+    Importers importing in parallel processes fork the worker thread they
+    run in, which isn't safe while other importer threads may hold locks
+    or pooled connections, so they can only be run with one worker.
+    """
+    if workers > 1 and any(importer.jobs > 1 for importer in importers):
+        raise ValueError(u'Importers with more than one job can not be run '
+                         u'with more than one worker')
+    dependencies = get_dependencies(importers)
+    pending = order_importers(importers)
+    ready = queue.Queue()
+    done = queue.Queue()
+
+    def work():
+        while True:
+            importer = ready.get()
+            if importer is None:
+                return
+            print(u'Running importer for {}...'.format(importer.filename))
+            started = time.time()
+            try:
+                importer.run()
+            except BaseException:
+                done.put((importer, None, sys.exc_info()))
+            else:
+                done.put((importer, time.time() - started, None))
+
+    threads = []
+    for num in range(max(1, min(workers, len(importers)))):
+        thread = threading.Thread(target=work,
+                                  name='geonames-importer-{}'.format(num))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    finished = set()
+    running = 0
+    timings = []
+    error = None
+    try:
+        while True:
+            if error is None:
+                for importer in list(pending):
+                    if all(dependency in finished
+                           for dependency in dependencies[importer]):
+                        pending.remove(importer)
+                        ready.put(importer)
+                        running += 1
+            if not running:
+                break
+            importer, seconds, exc_info = done.get()
+            running -= 1
+            if exc_info is not None:
+                error = error or exc_info
+                continue
+            finished.add(importer)
+            timings.append((importer, seconds))
+    finally:
+        for _ in threads:
+            ready.put(None)
+    for thread in threads:
+        thread.join()
+    if error is not None:
+        reraise(*error)
+    return timings
@@ -1,3 +1,11 @@
 import os
 
 DEBUG = 'SQLALCHEMY_GEONAMES_DEBUG' in os.environ
+
+# Ways of writing rows to the database. `insert` uses executemany INSERTs,
+# `copy` and `binary_copy` stream rows through PostgreSQL's
+# `COPY ... FROM STDIN` in text and binary format respectively.
+WRITE_METHODS = ('insert', 'copy', 'binary_copy')
+
+# When imported rows are committed, see `transactions`
+TRANSACTION_POLICIES = ('batch', 'rows', 'importer', 'run')
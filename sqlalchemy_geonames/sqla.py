@@ -1,8 +1,11 @@
 import sys
+import time
 
 from bunch import Bunch
-from sqlalchemy import engine, create_engine
+from sqlalchemy import engine, create_engine, select, func, and_, text, \
+    event, MetaData
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.schema import AddConstraint
 from sqlalchemy.orm import sessionmaker, scoped_session
 from utils import get_password
 
@@ -36,7 +39,7 @@ class Config(Bunch):
         if getattr(self, 'session', None):
             return self.session
 
-        engine = create_engine(db_url or self.get_db_url())
+        engine = create_db_engine(db_url or self.get_db_url())
         session_factory = sessionmaker(autocommit=False, autoflush=False)
         Session = scoped_session(session_factory)
         Session.configure(bind=engine)
@@ -57,18 +60,302 @@ config.host = 'localhost'
 config.port = None
 config.Base=declarative_base()
 config.schema_name='public'
+# Sequence of (name, value) run as `SET name = value` on every new database
+# connection, see `FAST_LOAD_SESSION_SETTINGS`.
+config.session_settings = ()
 
 
 PASSWORD_NOT_SET = object()
 
+# Session settings for full reloads, where durability is only needed once
+# all data is in place. A larger maintenance_work_mem speeds up building
+# indexes and constraints.
+FAST_LOAD_SESSION_SETTINGS = (
+    ('synchronous_commit', 'off'),
+    ('maintenance_work_mem', '512MB'),
+)
 
-def create_geoname_tables(db_session, recreate_tables=False):
+
+def create_db_engine(db_url):
+    """Creates an engine applying `config.session_settings` on connect"""
+    db_engine = create_engine(db_url)
+    session_settings = config.session_settings
+    if session_settings:
+        @event.listens_for(db_engine, 'connect')
+        def apply_session_settings(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in session_settings:
+                cursor.execute('SET {} = %s'.format(name), (value, ))
+            cursor.close()
+            # Settings made in a transaction are lost on rollback
+            dbapi_connection.commit()
+    return db_engine
+
+
+# Copies of the model tables' metadata in other schemas, by schema name
+_schema_metadata = {}
+
+
+def get_geoname_metadata(schema=None):
+    """Metadata of the geoname tables, in `schema` if given
+
+    For other schemas than `config.schema_name` the tables are copies of the
+    model tables, with foreign keys referring to the tables of `schema`.
+    Used to load data into a shadow schema.
+    """
+    if schema is None or schema == config.schema_name:
+        return config.Base.metadata
+    try:
+        return _schema_metadata[schema]
+    except KeyError:
+        metadata = MetaData()
+        for table in config.Base.metadata.sorted_tables:
+            table.tometadata(metadata, schema=schema)
+        _schema_metadata[schema] = metadata
+        return metadata
+
+
+def get_geoname_table(table, schema=None):
+    """Model table `table`, or its copy in `schema` if given"""
+    metadata = get_geoname_metadata(schema)
+    if metadata is config.Base.metadata:
+        return table
+    return metadata.tables['{}.{}'.format(schema, table.name)]
+
+
+def create_geoname_tables(db_session, recreate_tables=False, schema=None):
+    metadata = get_geoname_metadata(schema)
+    if schema is not None:
+        preparer = db_session.bind.dialect.identifier_preparer
+        db_session.bind.execute(text(u'CREATE SCHEMA IF NOT EXISTS {}'.format(
+            preparer.quote_schema(schema))))
     if recreate_tables:
-        config.Base.metadata.drop_all(bind=db_session.bind)
-    config.Base.metadata.create_all(bind=db_session.bind)
+        metadata.drop_all(bind=db_session.bind)
+    metadata.create_all(bind=db_session.bind)
 
 
-def purge_geoname_tables(db_session):
-    for table in reversed(config.Base.metadata.sorted_tables):
+def purge_geoname_tables(db_session, schema=None):
+    for table in reversed(get_geoname_metadata(schema).sorted_tables):
         print('Purging data from {}...'.format(table.name))
         db_session.bind.execute(table.delete())
+
+
+def set_geoname_tables_logged(db_session, logged=True, schema=None):
+    """Makes all tables LOGGED, or UNLOGGED if `logged` is False
+
+    Writes to UNLOGGED tables skip the write-ahead log, but their data is
+    lost on a crash. Returns a list of `(table name, seconds)`.
+    """
+    bind = db_session.bind
+    preparer = bind.dialect.identifier_preparer
+    # Logged tables can't reference unlogged ones, so referenced tables
+    # are made LOGGED first and UNLOGGED last.
+    tables = get_geoname_metadata(schema).sorted_tables
+    if not logged:
+        tables = list(reversed(tables))
+    timings = []
+    for table in tables:
+        print('Setting {} {}...'.format(
+            table.name, 'LOGGED' if logged else 'UNLOGGED'))
+        started = time.time()
+        with bind.begin() as connection:
+            connection.execute(text(u'ALTER TABLE {} SET {}'.format(
+                preparer.format_table(table),
+                'LOGGED' if logged else 'UNLOGGED')))
+        timings.append((table.name, time.time() - started))
+    return timings
+
+
+def analyze_geoname_tables(db_session, schema=None):
+    """Updates planner statistics. Returns a list of `(table, seconds)`"""
+    bind = db_session.bind
+    preparer = bind.dialect.identifier_preparer
+    timings = []
+    for table in get_geoname_metadata(schema).sorted_tables:
+        print('Analyzing {}...'.format(table.name))
+        started = time.time()
+        with bind.begin() as connection:
+            connection.execute(text(u'ANALYZE {}'.format(
+                preparer.format_table(table))))
+        timings.append((table.name, time.time() - started))
+    return timings
+
+
+class ConstraintViolationError(Exception):
+    """Raised when constraints could not be created because of bad data"""
+
+    def __init__(self, violations):
+        self.violations = violations
+        super(ConstraintViolationError, self).__init__(
+            u'\n'.join(violations))
+
+
+def _get_constraint_name(constraint):
+    """Name of `constraint`, or the default name PostgreSQL gives it"""
+    if constraint.name:
+        return constraint.name
+    table_name = constraint.table.name
+    if constraint is constraint.table.primary_key:
+        return '{}_pkey'.format(table_name)
+    column_names = '_'.join(c.name for c in constraint.columns)
+    return '{}_{}_fkey'.format(table_name, column_names)
+
+
+def _get_spatial_index_columns(table):
+    return [c for c in table.columns
+            if getattr(c.type, 'spatial_index', False)]
+
+
+def _get_spatial_index_name(column):
+    # Same name as geoalchemy2 gives spatial indexes
+    return 'idx_{}_{}'.format(column.table.name, column.name)
+
+
+def drop_geoname_constraints(db_session, schema=None):
+    """Drops primary keys, foreign keys and spatial indexes of all tables
+
+    Loading data into bare tables is a lot faster. Use
+    `create_geoname_constraints` to build them again after the load.
+    """
+    bind = db_session.bind
+    preparer = bind.dialect.identifier_preparer
+    tables = get_geoname_metadata(schema).sorted_tables
+    drop_constraint = u'ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}'
+    with bind.begin() as connection:
+        # Foreign keys first as they depend on the primary keys
+        for table in tables:
+            for fk in table.foreign_key_constraints:
+                connection.execute(text(drop_constraint.format(
+                    preparer.format_table(table),
+                    preparer.quote(_get_constraint_name(fk)))))
+        for table in tables:
+            if table.primary_key.columns:
+                connection.execute(text(drop_constraint.format(
+                    preparer.format_table(table),
+                    preparer.quote(_get_constraint_name(table.primary_key)))))
+            for column in _get_spatial_index_columns(table):
+                index_name = preparer.quote(_get_spatial_index_name(column))
+                if table.schema:
+                    index_name = u'{}.{}'.format(
+                        preparer.quote_schema(table.schema), index_name)
+                connection.execute(text(
+                    u'DROP INDEX IF EXISTS {}'.format(index_name)))
+
+
+def _count_duplicate_keys(connection, table, columns):
+    duplicates = select(columns).group_by(*columns)\
+        .having(func.count() > 1).alias()
+    return connection.scalar(select([func.count()]).select_from(duplicates))
+
+
+def _count_orphans(connection, fk):
+    referred_table = fk.elements[0].column.table
+    onclause = and_(*[e.parent == e.column for e in fk.elements])
+    whereclause = and_(*([e.parent.isnot(None) for e in fk.elements] +
+                         [fk.elements[0].column.is_(None)]))
+    return connection.scalar(
+        select([func.count()])
+        .select_from(fk.table.outerjoin(referred_table, onclause))
+        .where(whereclause))
+
+
+def create_geoname_constraints(db_session, schema=None):
+    """Builds the constraints dropped by `drop_geoname_constraints`
+
+    Each primary key, foreign key and spatial index is built in one pass
+    over its table. The data is checked before each constraint is added.
+    Constraints the data violates are skipped and a
+    `ConstraintViolationError` listing all violations is raised at the end.
+    """
+    bind = db_session.bind
+    preparer = bind.dialect.identifier_preparer
+    tables = get_geoname_metadata(schema).sorted_tables
+    violations = []
+    skipped_tables = set()
+
+    for table in tables:
+        pk = table.primary_key
+        if not pk.columns:
+            continue
+        with bind.begin() as connection:
+            num_duplicates = _count_duplicate_keys(connection, table,
+                                                   list(pk.columns))
+            if num_duplicates:
+                violations.append(
+                    u'{}: {} duplicated primary keys'.format(
+                        table.fullname, num_duplicates))
+                skipped_tables.add(table)
+                continue
+            print('Creating primary key for {}...'.format(table.name))
+            connection.execute(AddConstraint(pk))
+
+    for table in tables:
+        for fk in table.foreign_key_constraints:
+            referred_table = fk.elements[0].column.table
+            if referred_table in skipped_tables:
+                violations.append(
+                    u'{}: foreign key {} skipped as {} has no primary '
+                    u'key'.format(table.fullname, _get_constraint_name(fk),
+                                  referred_table.fullname))
+                continue
+            with bind.begin() as connection:
+                num_orphans = _count_orphans(connection, fk)
+                if num_orphans:
+                    violations.append(
+                        u'{}: {} rows violate foreign key {}'.format(
+                            table.fullname, num_orphans,
+                            _get_constraint_name(fk)))
+                    continue
+                print('Creating foreign key {}...'.format(
+                    _get_constraint_name(fk)))
+                connection.execute(AddConstraint(fk))
+
+    for table in tables:
+        for column in _get_spatial_index_columns(table):
+            print('Creating spatial index for {}.{}...'.format(
+                table.name, column.name))
+            with bind.begin() as connection:
+                connection.execute(text(
+                    u'CREATE INDEX {} ON {} USING GIST ({})'.format(
+                        preparer.quote(_get_spatial_index_name(column)),
+                        preparer.format_table(table),
+                        preparer.quote(column.name))))
+
+    if violations:
+        raise ConstraintViolationError(violations)
+
+
+def swap_geoname_schema(db_session, shadow_schema):
+    """Replaces the tables in `config.schema_name` with those in
+    `shadow_schema`, in one transaction
+
+    Readers of the live tables see either the old or the new data, never
+    an empty or half loaded table. The old tables are dropped, which fails
+    (and rolls back the swap) if other objects like views depend on them.
+    The emptied `shadow_schema` is dropped too.
+    """
+    bind = db_session.bind
+    preparer = bind.dialect.identifier_preparer
+    live_schema = preparer.quote_schema(config.schema_name)
+    old_schema = preparer.quote_schema(shadow_schema + '_old')
+    tables = get_geoname_metadata(shadow_schema).sorted_tables
+    print('Swapping tables of {} into {}...'.format(shadow_schema,
+                                                    config.schema_name))
+    with bind.begin() as connection:
+        connection.execute(text(u'CREATE SCHEMA {}'.format(old_schema)))
+        # Indexes, constraints and owned sequences move with their tables,
+        # so their names are free in the live schema once the old tables
+        # have been moved out.
+        for table in tables:
+            connection.execute(text(
+                u'ALTER TABLE IF EXISTS {}.{} SET SCHEMA {}'.format(
+                    live_schema, preparer.quote(table.name), old_schema)))
+        for table in tables:
+            connection.execute(text(u'ALTER TABLE {} SET SCHEMA {}'.format(
+                preparer.format_table(table), live_schema)))
+        for table in reversed(tables):
+            connection.execute(text(u'DROP TABLE IF EXISTS {}.{}'.format(
+                old_schema, preparer.quote(table.name))))
+        connection.execute(text(u'DROP SCHEMA {}'.format(old_schema)))
+        connection.execute(text(u'DROP SCHEMA {}'.format(
+            preparer.quote_schema(shadow_schema))))
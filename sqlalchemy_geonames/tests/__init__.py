@@ -1,15 +1,49 @@
 from __future__ import absolute_import
 
 import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from itertools import islice
+from zipfile import ZipFile, ZIP_DEFLATED
 
-from nose.tools import eq_, assert_greater
-from sqlalchemy import create_engine
+import requests
+from nose.tools import eq_, ok_, assert_greater, assert_raises
+from sqlalchemy import create_engine, Column, Integer, MetaData, Table, \
+    Text, select, text
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 # noinspection PyProtectedMember
 from sqla import GeonameBase
 from sqlalchemy_geonames.imports import _import_options_map, \
-    get_importer_instances
+    get_importer_instances, as_batch_modifier, set_geopoint_modifier, \
+    set_geopoints_modifier, clear_empty_fks_modifier, \
+    clear_empty_fks_batch_modifier, get_import_fields
+from sqlalchemy_geonames import reader
+from sqlalchemy_geonames.reader import COORDINATE_TYPES, RowFilter
+from sqlalchemy_geonames.batching import BatchSizer, estimate_row_size
+from sqlalchemy_geonames.transactions import ImportTransaction, RowError, \
+    execute_batch
+from sqlalchemy_geonames.checkpoints import ReadPositions
+from sqlalchemy_geonames import instrumentation, downloads, updates
+# noinspection PyProtectedMember
+from sqlalchemy_geonames._compat import BaseHTTPRequestHandler, HTTPServer
+from sqlalchemy_geonames.parallel import get_line_ranges
+from sqlalchemy_geonames.pipeline import run_pipelined
+from sqlalchemy_geonames.scheduling import order_importers, run_importers
+from sqlalchemy_geonames.models import GeonameFeature, GeonamePostalCode, \
+    Geoname, GeonameCountry, GeonameTimezone
+from sqlalchemy_geonames.pgcopy import TextCopyEncoder, CopyStream, \
+    BinaryCopyEncoder
+from sqlalchemy_geonames.sqla import config, create_geoname_tables, \
+    get_geoname_table, purge_geoname_tables, swap_geoname_schema, \
+    drop_geoname_constraints, create_geoname_constraints, \
+    ConstraintViolationError, set_geoname_tables_logged, create_db_engine, \
+    FAST_LOAD_SESSION_SETTINGS
+from sqlalchemy_geonames.bin import sqlageonames
 
 test_filenames = (
     'cities1000.txt',
@@ -26,6 +60,14 @@ Session = scoped_session(session_factory)
 Session.configure(bind=engine)
 
 
+def get_table_oid(schema, table_name):
+    return engine.scalar(text(
+        u'SELECT c.oid FROM pg_class c JOIN pg_namespace n '
+        u'ON n.oid = c.relnamespace '
+        u'WHERE n.nspname = :schema AND c.relname = :table_name'),
+        schema=schema, table_name=table_name)
+
+
 def get_tst_filepath(filename):
     return os.path.join(os.path.dirname(__file__), 'files', filename)
 
@@ -77,3 +119,746 @@ class TestBase(object):
         for importer in importers:
             importer.run()
             assert_greater(self.session.query(importer.model).count(), 1)
+
+    def import_files(self, *filenames):
+        filepaths = [get_tst_filepath(fn) for fn in filenames]
+        run_importers(get_importer_instances(
+            self.session, os.path.dirname(filepaths[0]), *filepaths))
+
+    def test_incremental_updates(self):
+        modifications_filepath = get_tst_filepath(
+            'modifications-2014-05-01.txt')
+        deletes_filepath = get_tst_filepath('deletes-2014-05-01.txt')
+        table = Geoname.__table__
+
+        def get_names(geonameid):
+            return [name for name, in engine.execute(
+                select([table.c.name]).where(table.c.geonameid == geonameid))]
+
+        purge_geoname_tables(self.session)
+        # Updates need a full import to start from
+        assert_raises(Exception, updates.get_pending_days, self.session)
+        latest = updates.get_latest_update_day()
+        with engine.begin() as connection:
+            updates.set_last_updated(connection, latest)
+        eq_(updates.get_pending_days(self.session), [])
+        with engine.begin() as connection:
+            updates.set_last_updated(connection, latest - timedelta(days=2))
+        eq_(updates.get_pending_days(self.session),
+            [latest - timedelta(days=1), latest])
+
+        self.import_files('featureCodes_en.txt', 'timeZones.txt',
+                          'countryInfo.txt', 'cities1000.txt')
+        num_geonames = self.session.query(Geoname).count()
+        day = date(2014, 5, 1)
+        updates.apply_day(self.session, day, modifications_filepath,
+                          deletes_filepath)
+        # Modified geonames are replaced, new ones added
+        eq_(get_names(1262410), [u'Murtajapur City'])
+        eq_(get_names(9999991), [u'Berlanga Nueva'])
+        eq_(get_names(647383), [])
+        eq_(self.session.query(Geoname).count(), num_geonames)
+        eq_(updates.get_last_updated(engine), day)
+        eq_(updates.get_pending_days(self.session)[0],
+            day + timedelta(days=1))
+
+    def test_shadow_schema_swap(self):
+        shadow_schema = 'shadow_test'
+        live_table = GeonameFeature.__table__
+        shadow_table = get_geoname_table(live_table, shadow_schema)
+
+        def feature(feature_code):
+            return {'feature_code': feature_code, 'feature_class': u'P',
+                    'name': feature_code, 'description': u''}
+
+        purge_geoname_tables(self.session)
+        engine.execute(live_table.insert(), [feature(u'OLD')])
+        create_geoname_tables(self.session, recreate_tables=True,
+                              schema=shadow_schema)
+        engine.execute(shadow_table.insert(), [feature(u'NEW')])
+        old_oid = get_table_oid(config.schema_name, live_table.name)
+        new_oid = get_table_oid(shadow_schema, live_table.name)
+
+        swap_geoname_schema(self.session, shadow_schema)
+        eq_([code for code, in engine.execute(
+            select([live_table.c.feature_code]))], [u'NEW'])
+        eq_(get_table_oid(config.schema_name, live_table.name), new_oid)
+        # The old tables are dropped along with both other schemas
+        eq_(engine.scalar(text(u'SELECT count(*) FROM pg_class '
+                               u'WHERE oid = :oid'), oid=old_oid), 0)
+        eq_(engine.scalar(text(
+            u'SELECT count(*) FROM information_schema.schemata '
+            u'WHERE schema_name IN (:shadow, :old)'),
+            shadow=shadow_schema, old=shadow_schema + '_old'), 0)
+
+    def test_deferred_constraints(self):
+        def get_constraint_names(table):
+            return set(name for name, in engine.execute(text(
+                u'SELECT conname FROM pg_constraint '
+                u'WHERE conrelid = CAST(:table AS regclass)'),
+                table=table.fullname))
+
+        country = GeonameCountry.__table__
+        geoname = Geoname.__table__
+        purge_geoname_tables(self.session)
+        drop_geoname_constraints(self.session)
+        try:
+            self.import_files('featureCodes_en.txt', 'timeZones.txt',
+                              'countryInfo.txt', 'cities1000.txt')
+            engine.execute(text(u'INSERT INTO {0} SELECT * FROM {0} '
+                                u"WHERE iso = 'SE'".format(country.fullname)))
+            engine.execute(geoname.update()
+                           .where(geoname.c.geonameid == 647383)
+                           .values(feature_code=u'NOPE'))
+            with assert_raises(ConstraintViolationError) as cm:
+                create_geoname_constraints(self.session)
+            skipped = (u'{}: foreign key {} skipped as public.country has no '
+                       u'primary key')
+            eq_(sorted(cm.exception.violations), sorted([
+                u'public.country: 1 duplicated primary keys',
+                skipped.format(u'public.geoname',
+                               u'geoname_country_code_fkey'),
+                skipped.format(u'public.postal_code',
+                               u'postal_code_country_code_fkey'),
+                u'public.geoname: 1 rows violate foreign key '
+                u'geoname_feature_code_fkey',
+            ]))
+            # Constraints of clean tables are built all the same
+            eq_(get_constraint_names(geoname),
+                set(['geoname_pkey', 'geoname_timezone_id_fkey']))
+            eq_(get_constraint_names(GeonameFeature.__table__),
+                set(['feature_pkey']))
+            eq_(get_constraint_names(country), set())
+            index_names = [name for name, in engine.execute(text(
+                u'SELECT indexname FROM pg_indexes '
+                u'WHERE schemaname = :schema'), schema=config.schema_name)]
+            ok_('idx_geoname_point' in index_names)
+        finally:
+            purge_geoname_tables(self.session)
+            drop_geoname_constraints(self.session)
+            create_geoname_constraints(self.session)
+
+    def test_logged_tables(self):
+        table_names = [table.name
+                       for table in config.Base.metadata.sorted_tables]
+
+        def get_persistences():
+            return set(persistence for persistence, in engine.execute(text(
+                u'SELECT c.relpersistence FROM pg_class c '
+                u'JOIN pg_namespace n ON n.oid = c.relnamespace '
+                u'WHERE n.nspname = :schema AND c.relname IN :table_names'),
+                schema=config.schema_name, table_names=tuple(table_names)))
+
+        # Referring tables are made UNLOGGED first and LOGGED last
+        timings = set_geoname_tables_logged(self.session, logged=False)
+        eq_([name for name, seconds in timings], table_names[::-1])
+        eq_(get_persistences(), set(['u']))
+        timings = set_geoname_tables_logged(self.session)
+        eq_([name for name, seconds in timings], table_names)
+        eq_(get_persistences(), set(['p']))
+
+        config.session_settings = FAST_LOAD_SESSION_SETTINGS
+        try:
+            fast_engine = create_db_engine(connstr)
+        finally:
+            config.session_settings = ()
+        try:
+            for name, value in FAST_LOAD_SESSION_SETTINGS:
+                eq_(fast_engine.scalar(text(u'SHOW {}'.format(name))), value)
+        finally:
+            fast_engine.dispose()
+
+        # Tables are made LOGGED again when a fast load fails
+        def failing_run_importers(*args, **kwargs):
+            raise ValueError(u'Import failed')
+
+        download_all = sqlageonames.download_all
+        cli_run_importers = sqlageonames.run_importers
+        sqlageonames.download_all = lambda *args: None
+        sqlageonames.run_importers = failing_run_importers
+        config.session = self.session
+        try:
+            assert_raises(ValueError, sqlageonames.download_and_import,
+                          'cities1000.txt', 'postgresql', 'sqla_geonames',
+                          config.schema_name, 'sqla_geonames',
+                          fast_load=True)
+            eq_(get_persistences(), set(['p']))
+        finally:
+            sqlageonames.download_all = download_all
+            sqlageonames.run_importers = cli_run_importers
+            del config.session
+            config.session_settings = ()
+
+    # noinspection PyMethodMayBeStatic
+    def test_deletes_reader(self):
+        filepath = get_tst_filepath('deletes-2014-05-01.txt')
+        eq_(list(reader.GeonameDeletesReader(filepath)), [
+            {'geonameid': 647383, 'name': u'Luopioinen',
+             'comment': u'duplicate of 656130'},
+            {'geonameid': 9999992, 'name': u'Never imported',
+             'comment': u''},
+        ])
+
+    # noinspection PyMethodMayBeStatic
+    def test_copy_text_encoding(self):
+        table = GeonameFeature.__table__
+        encoder = TextCopyEncoder([table.c.feature_code, table.c.name,
+                                   table.c.description])
+        rows = [
+            {'feature_code': u'PPL', 'name': u'tab\there',
+             'description': u'back\\slash\nnewline'},
+            {'feature_code': u'PPLA', 'name': u'Sm\xe5land'},
+        ]
+        stream = CopyStream(rows, encoder)
+        eq_(stream.read(5), b'PPL\tt')
+        eq_(stream.read(), (u'ab\\there\tback\\\\slash\\nnewline\n'
+                            u'PPLA\tSm\xe5land\t\\N\n').encode('utf-8'))
+        eq_(stream.read(), b'')
+        eq_(stream.row_count, 2)
+
+    # noinspection PyMethodMayBeStatic
+    def test_copy_binary_encoding(self):
+        table = GeonamePostalCode.__table__
+        encoder = BinaryCopyEncoder([table.c.postal_code, table.c.point,
+                                     table.c.accuracy])
+        row = encoder.encode_row({'postal_code': u'10115',
+                                  'point': u'POINT(52.5 13.25)',
+                                  'accuracy': None})
+        ewkb = (b'\x01\x01\x00\x00\x20\xe6\x10\x00\x00'
+                b'\x00\x00\x00\x00\x00\x40\x4a\x40'
+                b'\x00\x00\x00\x00\x00\x80\x2a\x40')
+        eq_(row, b'\x00\x03' + b'\x00\x00\x00\x0510115' +
+            b'\x00\x00\x00\x19' + ewkb + b'\xff\xff\xff\xff')
+        eq_(encoder.encode_row({'postal_code': u'10115',
+                                'point': (52.5, 13.25), 'accuracy': None}),
+            row)
+
+    # noinspection PyMethodMayBeStatic
+    def test_parallel_line_ranges(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        ranges = get_line_ranges(filepath, 4, block_size=1000)
+        eq_(len(ranges), 4)
+        rows = []
+        for start, end, start_rownum in ranges:
+            rows.extend(file_class(filepath, start=start, end=end,
+                                   start_rownum=start_rownum))
+        eq_(rows, list(file_class(filepath)))
+
+    # noinspection PyMethodMayBeStatic
+    def test_pipeline(self):
+        written = []
+        run_pipelined(range(1234), written.extend, batch_size=100,
+                      max_batches=2)
+        eq_(written, list(range(1234)))
+
+        def failing_writer(rows):
+            for i, row in enumerate(rows):
+                if i == 150:
+                    raise ValueError(row)
+
+        produced = []
+
+        def producer():
+            for i in range(100000):
+                produced.append(i)
+                yield i
+
+        assert_raises(ValueError, run_pipelined, producer(), failing_writer,
+                      batch_size=100, max_batches=2)
+        # The producer stops once the writer has failed
+        assert len(produced) < 1000
+
+    # noinspection PyMethodMayBeStatic
+    def test_zip_member_reader(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            zip_filepath = os.path.join(tmp_dir, 'cities1000.zip')
+            with ZipFile(zip_filepath, 'w', ZIP_DEFLATED) as zip_file:
+                zip_file.write(filepath, 'cities1000.txt')
+            eq_(list(file_class(zip_filepath, member='cities1000.txt')),
+                list(file_class(filepath)))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    # noinspection PyMethodMayBeStatic
+    def test_columnar_reader(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        rows = list(file_class(filepath))
+        batches = list(file_class(filepath).iter_columns(batch_size=300))
+        eq_([len(batch['name']) for batch in batches], [300, 300, 300, 100])
+        for key in ('geonameid', 'name', 'population', 'modification_date'):
+            column = [value for batch in batches for value in batch[key]]
+            eq_(column, [row[key] for row in rows])
+
+    # noinspection PyMethodMayBeStatic
+    def test_batch_modifiers(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        batch_modifiers = [set_geopoints_modifier,
+                           clear_empty_fks_batch_modifier]
+        row_modifiers = [as_batch_modifier(set_geopoint_modifier),
+                         as_batch_modifier(clear_empty_fks_modifier)]
+        eq_(as_batch_modifier(set_geopoints_modifier), set_geopoints_modifier)
+        results = []
+        for modifiers in (batch_modifiers, row_modifiers):
+            rows = list(file_class(filepath))
+            for modifier in modifiers:
+                rows = modifier(None, None, rows)
+            results.append(rows)
+        eq_(results[0], results[1])
+        eq_(results[0][0]['point'], u'POINT({} {})'.format(
+            results[0][0]['latitude'], results[0][0]['longitude']))
+
+    # noinspection PyMethodMayBeStatic
+    def test_coordinate_modes(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        rows = list(file_class(filepath))
+        for coordinates in ('decimal', 'float', 'text'):
+            mode_rows = list(file_class(filepath, coordinates=coordinates))
+            eq_(type(mode_rows[0]['latitude']),
+                COORDINATE_TYPES[coordinates])
+            eq_([float(row['longitude']) for row in mode_rows],
+                [float(row['longitude']) for row in rows])
+        # Points made from text coordinates are the same
+        text_rows = list(file_class(filepath, coordinates='text'))
+        eq_([row['point'] for row in
+             set_geopoints_modifier(None, None, text_rows)],
+            [row['point'] for row in
+             set_geopoints_modifier(None, None, rows)])
+
+    # noinspection PyMethodMayBeStatic
+    def test_mmap_reader_engine(self):
+        for filename in test_filenames:
+            filepath = get_tst_filepath(filename)
+            file_class = _import_options_map[filename].file_class
+            eq_(list(file_class(filepath, engine='mmap')),
+                list(file_class(filepath, engine='lines')))
+        # Blocks split on line endings, also within a range
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        block_size = reader.MMAP_BLOCK_SIZE
+        reader.MMAP_BLOCK_SIZE = 100
+        try:
+            start, end, start_rownum = get_line_ranges(filepath, 2)[1]
+            eq_(list(file_class(filepath, start=start, end=end,
+                                start_rownum=start_rownum)),
+                list(file_class(filepath, engine='lines'))[start_rownum:])
+        finally:
+            reader.MMAP_BLOCK_SIZE = block_size
+        assert_raises(ValueError, file_class, filepath, engine='unknown')
+
+    # noinspection PyMethodMayBeStatic
+    def test_field_projection(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        fields = ('geonameid', 'name', 'latitude', 'longitude',
+                  'country_code')
+        rows = list(file_class(filepath))
+        projected = file_class(filepath, fields=fields)
+        eq_(set(projected.field_names), set(fields))
+        eq_(list(projected),
+            [dict((key, row[key]) for key in fields) for row in rows])
+        batch = next(file_class(filepath, fields=fields).iter_columns())
+        eq_(set(batch), set(fields))
+        assert_raises(ValueError, file_class, filepath, fields=['unknown'])
+
+        # Only the columns of the table and the fields used by the modifiers
+        # are read when importing
+        table = GeonameFeature.__table__
+        eq_(get_import_fields(file_class, table, []),
+            ['name', 'feature_class', 'feature_code'])
+        eq_(get_import_fields(file_class, table, [set_geopoints_modifier]),
+            ['name', 'latitude', 'longitude', 'feature_class',
+             'feature_code'])
+        eq_(get_import_fields(file_class, table,
+                              [set_geopoints_modifier, lambda s, m, r: r]),
+            None)
+
+    # noinspection PyMethodMayBeStatic
+    def test_row_filter(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        rows = list(file_class(filepath))
+
+        def filtered(**kwargs):
+            return list(file_class(filepath, row_filter=RowFilter(**kwargs)))
+
+        eq_(filtered(), rows)
+        eq_(filtered(country_codes=['SE', 'NO']),
+            [row for row in rows if row['country_code'] in ('SE', 'NO')])
+        eq_(filtered(feature_codes=['PPLC'], min_population=100000),
+            [row for row in rows if row['feature_code'] == 'PPLC' and
+             row['population'] >= 100000])
+        eq_(filtered(feature_classes=['P'], bbox=(50, 0, 60, 20)),
+            [row for row in rows if 50 <= row['latitude'] <= 60 and
+             0 <= row['longitude'] <= 20])
+        # Across the 180th meridian
+        eq_(filtered(bbox=(-90, 170, 90, -170)),
+            [row for row in rows if abs(row['longitude']) >= 170])
+        # Conditions on fields the file doesn't have are left out
+        row_filter = RowFilter(feature_classes=['P'], country_codes=['SE'])
+        accept_row = row_filter.compile(['country_code', 'postal_code'])
+        ok_(accept_row([u'SE', u'111 20']))
+        ok_(not accept_row([u'NO', u'0150']))
+
+    # noinspection PyMethodMayBeStatic
+    def test_record_rows(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        rows = list(file_class(filepath))
+        records = list(file_class(filepath, records=True))
+        eq_(records, rows)
+        record = records[0]
+        eq_(record['name'], record.name)
+        eq_(record.get('point'), None)
+        ok_('name' in record and 'point' not in record)
+        eq_(record.keys(), [fd[0] for fd in file_class.field_definitions])
+        assert_raises(KeyError, record.__setitem__, 'point', u'POINT(0 0)')
+        assert_raises(AttributeError, setattr, record, 'point', None)
+        # Projected fields only
+        fields = ('geonameid', 'name')
+        record = next(iter(file_class(filepath, fields=fields, records=True)))
+        eq_(record._asdict(), dict((key, rows[0][key]) for key in fields))
+        # Encoded like dicts
+        encoder = TextCopyEncoder([GeonameFeature.__table__.c.name])
+        eq_(encoder.encode_row(record), encoder.encode_row(rows[0]))
+        # Inserted like dicts
+        sqlite_engine = create_engine('sqlite://')
+        table = Table('record_test', MetaData(),
+                      Column('geonameid', Integer, primary_key=True),
+                      Column('name', Text))
+        table.create(bind=sqlite_engine)
+
+        def insert(rows):
+            sqlite_engine.execute(table.delete())
+            sqlite_engine.execute(table.insert(), rows)
+            return sqlite_engine.execute(
+                table.select().order_by(table.c.geonameid)).fetchall()
+
+        eq_(insert(list(file_class(filepath, fields=fields, records=True))),
+            insert([dict((key, row[key]) for key in fields) for row in rows]))
+
+    # noinspection PyMethodMayBeStatic
+    def test_interned_fields(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        file_class = _import_options_map['cities1000.txt'].file_class
+        rows = list(file_class(filepath, interned_fields=()))
+        interned = list(file_class(filepath))
+        eq_(interned, rows)
+        countries = set(id(row['country_code']) for row in interned)
+        eq_(len(countries), len(set(row['country_code'] for row in rows)))
+
+        file_reader = file_class(filepath, records=True,
+                                 dictionary_encode=True)
+        encoded = list(file_reader)
+        values = file_reader.get_dictionary('feature_code')
+        eq_([values[row.feature_code] for row in encoded],
+            [row['feature_code'] for row in rows])
+        eq_(encoded[0].feature_code, 0)
+        file_reader = file_class(filepath, dictionary_encode=True)
+        codes = [code for batch in file_reader.iter_columns(batch_size=300)
+                 for code in batch['country_code']]
+        values = file_reader.get_dictionary('country_code')
+        eq_([values[code] for code in codes],
+            [row['country_code'] for row in rows])
+        assert_raises(ValueError, file_class, filepath,
+                      interned_fields=['unknown'])
+
+    # noinspection PyMethodMayBeStatic
+    def test_batch_sizer(self):
+        # Writing is fastest at batches of 4000 rows
+        def seconds(size):
+            return size / (10000.0 - abs(4000 - size))
+
+        rows = [{'name': u'x' * 10}] * 50000
+        batch_sizer = BatchSizer(initial=500, max_memory=None)
+        for _ in range(50):
+            batch_sizer.record(rows[:batch_sizer.size],
+                               seconds(batch_sizer.size))
+        ok_(batch_sizer.settled)
+        eq_(batch_sizer.size, 4000)
+        # Smaller last batches are ignored
+        batch_sizer = BatchSizer(initial=500, max_memory=None)
+        batch_sizer.record(rows[:100], 1)
+        eq_(batch_sizer.size, 500)
+        # Batches are kept within the memory limit
+        row_size = estimate_row_size(rows)
+        batch_sizer = BatchSizer(initial=500, max_memory=row_size * 1000)
+        for _ in range(50):
+            batch_sizer.record(rows[:batch_sizer.size],
+                               seconds(batch_sizer.size))
+        eq_(batch_sizer.size, 1000)
+
+    # noinspection PyMethodMayBeStatic
+    def test_transaction_policies(self):
+        table = Table('transaction_test', MetaData(),
+                      Column('id', Integer, primary_key=True))
+        table.create(bind=engine, checkfirst=True)
+
+        def write(policy, ids, skip_bad_rows=False, commit_every=None):
+            connection = engine.connect()
+            connection.execute(table.delete())
+            connection.execute(table.insert(), {'id': 7})
+            try:
+                with ImportTransaction(connection, policy,
+                                       commit_every) as transaction:
+                    for batch_ids in ids:
+                        rows = [{'id': id_} for id_ in batch_ids]
+                        transaction.rows_written(execute_batch(
+                            connection, table.insert(), rows,
+                            skip_bad_rows=skip_bad_rows))
+            except RowError as exc:
+                eq_(exc.row, {'id': 7})
+            finally:
+                written = sorted(
+                    id_ for id_, in connection.execute(table.select()))
+                connection.close()
+            return written
+
+        try:
+            ids = [range(0, 5), range(5, 10)]
+            # The failing row is found and nothing is committed
+            eq_(write('importer', ids), [7])
+            # or everything else is
+            eq_(write('importer', ids, skip_bad_rows=True), list(range(10)))
+            # Batches before the failing one are kept
+            eq_(write('batch', ids), [0, 1, 2, 3, 4, 7])
+            eq_(write('rows', ids, commit_every=10), [7])
+            assert_raises(ValueError, ImportTransaction, None, 'rows')
+        finally:
+            table.drop(bind=engine)
+
+    # noinspection PyMethodMayBeStatic
+    def test_importer_scheduling(self):
+        lock = threading.Lock()
+        running = set()
+        overlapping = []
+
+        class FakeImporter(object):
+            def __init__(self, model, model_dependencies=(), fail=False,
+                         jobs=1):
+                self.model = model
+                self.model_dependencies = model_dependencies
+                self.filename = model.__tablename__
+                self.fail = fail
+                self.jobs = jobs
+
+            def run(self):
+                with lock:
+                    eq_([dep for dep in self.model_dependencies
+                         if dep.__tablename__ in running], [])
+                    running.add(self.filename)
+                    overlapping.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.remove(self.filename)
+                if self.fail:
+                    raise ValueError(self.filename)
+
+        def get_importers(fail=False):
+            return [
+                FakeImporter(Geoname, [GeonameFeature, GeonameTimezone,
+                                       GeonameCountry], fail=fail),
+                FakeImporter(GeonamePostalCode, [Geoname, GeonameCountry]),
+                FakeImporter(GeonameFeature),
+                FakeImporter(GeonameTimezone),
+                FakeImporter(GeonameCountry),
+            ]
+
+        eq_([importer.filename for importer in
+             order_importers(get_importers())],
+            ['feature', 'timezone', 'country', 'geoname', 'postal_code'])
+        timings = run_importers(get_importers(), workers=3)
+        eq_([importer.filename for importer, seconds in timings][-2:],
+            ['geoname', 'postal_code'])
+        # The independent importers ran at the same time
+        eq_(max(overlapping), 3)
+        # One at a time, in order
+        del overlapping[:]
+        timings = run_importers(get_importers(), workers=1)
+        eq_(max(overlapping), 1)
+        eq_([importer.filename for importer, seconds in timings],
+            ['feature', 'timezone', 'country', 'geoname', 'postal_code'])
+        # Importers depending on a failed one aren't run
+        del overlapping[:]
+        assert_raises(ValueError, run_importers, get_importers(fail=True), 3)
+        eq_(len(overlapping), 4)
+        # Importers forking worker processes only run with one worker
+        importers = [FakeImporter(Geoname, jobs=2),
+                     FakeImporter(GeonameCountry)]
+        assert_raises(ValueError, run_importers, importers, 2)
+        eq_(len(run_importers(importers, 1)), 2)
+        # Dependency cycles are refused
+        importers = [FakeImporter(Geoname, [GeonameCountry]),
+                     FakeImporter(GeonameCountry, [Geoname])]
+        assert_raises(Exception, order_importers, importers)
+
+    # noinspection PyMethodMayBeStatic
+    def test_read_positions(self):
+        filepath = get_tst_filepath('cities1000.txt')
+        for engine in reader.READER_ENGINES:
+            for num_rows in (0, 1, 500, 5000):
+                file_reader = reader.GeonameReader(filepath, engine=engine)
+                rows = iter(file_reader)
+                list(islice(rows, num_rows))
+                start, start_rownum = file_reader.get_position()
+                # Reading on from the position gives the rest of the rows
+                eq_(list(reader.GeonameReader(filepath, engine=engine,
+                                              start=start,
+                                              start_rownum=start_rownum)),
+                    list(rows))
+        positions = ReadPositions()
+        positions.add(0, (0, 0))
+        positions.add(1000, (150000, 1000))
+        positions.add(2000, (300000, 2000))
+        eq_(positions.get(500), (0, 0, 500))
+        eq_(positions.get(1500), (150000, 1000, 500))
+        eq_(positions.get(2000), (300000, 2000, 0))
+
+    # noinspection PyMethodMayBeStatic
+    def test_import_stats(self):
+        events = []
+
+        def hook(event, stats):
+            events.append((event, stats.last_batch))
+
+        stats = instrumentation.ImportStats('geoname')
+        instrumentation.add_hook(hook)
+        try:
+            with stats.measure():
+                with stats.timer('write') as timing:
+                    # Time in nested stages only counts for those
+                    with stats.timer('parse'):
+                        time.sleep(0.02)
+                eq_(stats.stages['write'], timing.seconds)
+                ok_(timing.seconds < 0.01)
+                ok_(stats.stages['parse'] >= 0.02)
+                stats.record_batch(500, 0.003)
+                stats.record_batch(500, 0.004)
+                stats.record_batch(100, 0.3)
+        finally:
+            instrumentation.remove_hook(hook)
+        eq_(events, [('batch', (500, 0.003)), ('batch', (500, 0.004)),
+                     ('batch', (100, 0.3)), ('done', (100, 0.3))])
+        eq_(stats.rows, 1100)
+        eq_(stats.latency_percentile(50), 5)
+        eq_(stats.latency_percentile(95), 500)
+        ok_(stats.rows_per_second > 0)
+        # Stats of parallel imports are sent between processes and merged
+        stats.merge(pickle.loads(pickle.dumps(stats)))
+        eq_(stats.rows, 2200)
+        eq_(stats.latencies[:4], [0, 0, 4, 0])
+        eq_(len(instrumentation.format_stats([stats])), 2)
+        # Readers of memory-mapped files measure decoding
+        stats = instrumentation.ImportStats('geoname')
+        list(reader.GeonameReader(get_tst_filepath('cities1000.txt'),
+                                  engine='mmap', stats=stats))
+        ok_(stats.stages['decode'] > 0)
+
+    # noinspection PyMethodMayBeStatic
+    def test_downloads(self):
+        files = {'/allCountries.zip': (b'geonames' * 30000, '"v1"')}
+        seen_headers = []
+        # Bytes to send of the next response before dropping the connection
+        fail_after = []
+        # Byte to start the next partial response at instead of the one asked
+        wrong_range = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                seen_headers.append(self.headers)
+                if self.path not in files:
+                    self.send_error(404)
+                    return
+                content, etag = files[self.path]
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                start = 0
+                if (self.headers.get('Range') and
+                        self.headers.get('If-Range') == etag):
+                    start = int(self.headers['Range'][6:-1])
+                    if wrong_range:
+                        start = wrong_range.pop()
+                    self.send_response(206)
+                    self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                        start, len(content) - 1, len(content)))
+                else:
+                    self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', len(content) - start)
+                self.end_headers()
+                body = content[start:]
+                if fail_after:
+                    body = body[:fail_after.pop()]
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        download_dir = tempfile.mkdtemp()
+        try:
+            url = 'http://127.0.0.1:{}/allCountries.zip'.format(
+                server.server_port)
+            filepath = os.path.join(download_dir, 'allCountries.zip')
+
+            def download_file(**kwargs):
+                return downloads.download_file(url, filepath,
+                                               chunk_size=10000, **kwargs)
+
+            # An interrupted download is continued where it stopped
+            fail_after.append(55000)
+            assert_raises(IOError, download_file)
+            ok_(not os.path.exists(filepath))
+            part_size = os.path.getsize(filepath + '.part')
+            ok_(0 < part_size < 240000)
+            eq_(download_file(), downloads.RESUMED)
+            eq_(seen_headers[-1]['Range'], 'bytes={}-'.format(part_size))
+            with open(filepath, 'rb') as fh:
+                eq_(fh.read(), files['/allCountries.zip'][0])
+            # Unchanged files aren't downloaded again
+            eq_(download_file(), downloads.UNCHANGED)
+            eq_(seen_headers[-1]['If-None-Match'], '"v1"')
+            eq_(download_file(use_cache=True), downloads.CACHED)
+            # A part of a file that has changed since is started over
+            fail_after.append(25000)
+            files['/allCountries.zip'] = (b'geoname' * 30000, '"v2"')
+            assert_raises(IOError, download_file)
+            files['/allCountries.zip'] = (b'geo' * 30000, '"v3"')
+            eq_(download_file(), downloads.DOWNLOADED)
+            eq_(seen_headers[-1]['If-Range'], '"v2"')
+            with open(filepath, 'rb') as fh:
+                eq_(fh.read(), b'geo' * 30000)
+            # A part continued at another byte than asked is started over
+            fail_after.append(25000)
+            files['/allCountries.zip'] = (b'geonames' * 20000, '"v4"')
+            assert_raises(IOError, download_file)
+            wrong_range.append(10)
+            eq_(download_file(), downloads.DOWNLOADED)
+            ok_('Range' not in seen_headers[-1])
+            with open(filepath, 'rb') as fh:
+                eq_(fh.read(), b'geonames' * 20000)
+            # Files are downloaded at the same time
+            files['/countryInfo.txt'] = (b'country' * 1000, '"v1"')
+            eq_(downloads.download_files(
+                [(url, filepath),
+                 (url.replace('allCountries.zip', 'countryInfo.txt'),
+                  os.path.join(download_dir, 'countryInfo.txt'))],
+                workers=2), [downloads.UNCHANGED, downloads.DOWNLOADED])
+            assert_raises(requests.HTTPError, downloads.download_file,
+                          url.replace('allCountries', 'missing'),
+                          os.path.join(download_dir, 'missing.zip'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(download_dir)
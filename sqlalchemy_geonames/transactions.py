@@ -0,0 +1,111 @@
+"""When rows written by the importers are committed
+
+The transaction policies, see `settings.TRANSACTION_POLICIES`:
+
+* `batch` commits after every write, i.e. every INSERT batch or COPY.
+* `rows` commits every `commit_every` rows.
+* `importer` commits once each importer is done. A failed import leaves
+  its table as it was.
+* `run` commits once all importers are done. The connection and its
+  transaction are then owned by the caller, see `sqlageonames`.
+
+INSERT batches are written in savepoints. A failing batch is rolled back to
+its savepoint and bisected, each half in its own savepoint, until the
+failing rows are found. Rows written before stay in the transaction.
+"""
+from __future__ import absolute_import
+
+from sqlalchemy.exc import DBAPIError
+
+from sqlalchemy_geonames import log
+
+logger = log.get_logger()
+
+
+class RowError(Exception):
+    """A row could not be written to the database"""
+
+    def __init__(self, row, error):
+        self.row = row
+        self.error = error
+        super(RowError, self).__init__(u'Could not write row {!r}: {}'.format(
+            dict(row), error))
+
+
+class ImportTransaction(object):
+    """Begins and commits transactions on `connection` as rows are written
+
+    Used as a context manager around the writes of an importer. The last
+    transaction is committed on exit, or rolled back if an exception was
+    raised. With the `run` policy the caller has already begun the
+    transaction, which makes these no-ops.
+
+    `checkpoint` is called before each commit with the connection, the
+    number of rows written so far and whether all rows are, to record the
+    progress in the same transaction. See `checkpoints`.
+    """
+
+    def __init__(self, connection, policy='importer', commit_every=None,
+                 checkpoint=None):
+        if policy == 'rows' and not commit_every:
+            raise ValueError(u'The rows transaction policy needs '
+                             u'commit_every')
+        self.connection = connection
+        self.policy = policy
+        self.commit_every = commit_every
+        self.checkpoint = checkpoint
+        self.transaction = None
+        self.written = 0
+        self.uncommitted = 0
+
+    def __enter__(self):
+        self.transaction = self.connection.begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            if self.checkpoint is not None:
+                self.checkpoint(self.connection, self.written, True)
+            self.transaction.commit()
+        else:
+            self.transaction.rollback()
+
+    def rows_written(self, num_rows):
+        """Commits if it's time to according to the policy"""
+        self.written += num_rows
+        self.uncommitted += num_rows
+        if (self.policy == 'batch' or
+                self.policy == 'rows' and
+                self.uncommitted >= self.commit_every):
+            if self.checkpoint is not None:
+                self.checkpoint(self.connection, self.written, False)
+            self.transaction.commit()
+            self.transaction = self.connection.begin()
+            self.uncommitted = 0
+
+
+def execute_batch(connection, statement, rows, skip_bad_rows=False):
+    """Executes `statement` with `rows` in a savepoint
+
+    If it fails the batch is bisected to find the failing rows. Those are
+    logged and skipped if `skip_bad_rows` is enabled, otherwise a `RowError`
+    is raised for the first one. Returns the number of rows written.
+    """
+    savepoint = connection.begin_nested()
+    try:
+        connection.execute(statement, rows)
+    except DBAPIError as exc:
+        savepoint.rollback()
+        if len(rows) == 1:
+            if not skip_bad_rows:
+                raise RowError(rows[0], exc.orig)
+            logger.warning(u'Skipped row {!r}: {}'.format(dict(rows[0]),
+                                                          exc.orig))
+            return 0
+        middle = len(rows) // 2
+        return (execute_batch(connection, statement, rows[:middle],
+                              skip_bad_rows) +
+                execute_batch(connection, statement, rows[middle:],
+                              skip_bad_rows))
+    savepoint.commit()
+    return len(rows)
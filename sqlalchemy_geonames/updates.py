@@ -0,0 +1,102 @@
+"""Incremental updates from geonames' daily modification and delete files
+
+geonames.org publishes `modifications-YYYY-MM-DD.txt` (rows in the same
+format as allCountries.txt) and `deletes-YYYY-MM-DD.txt` for every day. Each
+day is applied in its own transaction, together with recording the day in
+`GeonameMetadata.last_updated`, so an interrupted update can simply be run
+again.
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from sqlalchemy_geonames import models, reader, sqla
+from sqlalchemy_geonames.imports import GeonameImportOptions, Importer
+from sqlalchemy_geonames.utils import batched
+
+# Only one row is kept in the metadata table
+METADATA_ID = 1
+
+
+def _get_metadata_table(schema=None):
+    return sqla.get_geoname_table(models.GeonameMetadata.__table__, schema)
+
+
+def get_last_updated(connection, schema=None):
+    """Returns the day of the last applied update, or None"""
+    table = _get_metadata_table(schema)
+    last_updated = connection.scalar(
+        select([table.c.last_updated]).where(table.c.id == METADATA_ID))
+    return last_updated.date() if last_updated is not None else None
+
+
+def set_last_updated(connection, day, schema=None):
+    """Records `day` as the day of the last applied update"""
+    table = _get_metadata_table(schema)
+    last_updated = datetime(day.year, day.month, day.day)
+    result = connection.execute(
+        table.update().where(table.c.id == METADATA_ID)
+        .values(last_updated=last_updated))
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(id=METADATA_ID,
+                                                 last_updated=last_updated))
+
+
+def clear_last_updated(connection, schema=None):
+    """Forgets the last applied update, so no updates are applied until
+    allCountries.txt is imported in full
+    """
+    table = _get_metadata_table(schema)
+    connection.execute(table.delete().where(table.c.id == METADATA_ID))
+
+
+def get_latest_update_day():
+    """The last day with published updates. Files for a day are published
+    the day after, as dates go in UTC on geonames.org.
+    """
+    return datetime.utcnow().date() - timedelta(days=1)
+
+
+def get_pending_days(db_session):
+    """Days with updates not yet applied, oldest first"""
+    last_updated = get_last_updated(db_session.bind)
+    if last_updated is None:
+        raise Exception(u'No full import has been recorded. Import '
+                        u'allCountries.txt without filters before applying '
+                        u'updates.')
+    latest = get_latest_update_day()
+    days = []
+    day = last_updated + timedelta(days=1)
+    while day <= latest:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def apply_day(db_session, day, modifications_filepath, deletes_filepath,
+              batch_size=Importer.num_simoultaneous_inserts):
+    """Applies the modifications and deletes of `day`
+
+    Modified geonames are upserted by deleting and re-inserting each batch
+    of rows, which is safe as no other table refers to the geoname table.
+    """
+    importer = Importer(GeonameImportOptions, modifications_filepath,
+                        db_session, os.path.dirname(modifications_filepath),
+                        write_method='insert')
+    table = importer.table
+    geonameid = table.c.geonameid
+    print(u'Applying updates for {}...'.format(day.isoformat()))
+    with db_session.bind.begin() as connection:
+        for batch in batched(importer.iter_rows(), batch_size):
+            connection.execute(table.delete().where(
+                geonameid.in_([row['geonameid'] for row in batch])))
+            connection.execute(table.insert(), batch)
+        deletes = reader.GeonameDeletesReader(deletes_filepath)
+        for batch in batched(deletes, batch_size):
+            connection.execute(table.delete().where(
+                geonameid.in_([row['geonameid'] for row in batch])))
+        set_last_updated(connection, day)
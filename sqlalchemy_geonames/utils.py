@@ -39,6 +39,18 @@ def try_int(value):
         return None
 
 
+def batched(iterable, batch_size):
+    """Yields lists of up to `batch_size` items from `iterable`"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def normalize_path(path):
     return os.path.abspath(os.path.expanduser(path))
 